@@ -0,0 +1,169 @@
+"""asyncio front-end for the task managers
+
+Author: Pyrallel contributors
+Licensed: MIT
+"""
+import asyncio
+import threading
+import weakref
+
+from pyrallel.common import is_aborted
+from pyrallel.common import task_attempts
+
+
+# Serialize the access to each IPython client between the event loop and
+# the executor threads used to run the blocking launch methods: the client
+# sockets are not thread safe.
+_client_locks = weakref.WeakKeyDictionary()
+_client_locks_lock = threading.Lock()
+
+
+def _client_lock(manager):
+    """Lock guarding the client used by manager
+
+    Managers sharing an IPython client share its lock. The backends that
+    are thread safe have no client to share: the lock of the manager only
+    guards its own state against its launches.
+    """
+    backend = manager.backend
+    owner = manager
+    if not backend.thread_safe:
+        owner = getattr(backend, 'client', backend)
+    with _client_locks_lock:
+        lock = _client_locks.get(owner)
+        if lock is None:
+            lock = _client_locks[owner] = threading.RLock()
+    return lock
+
+
+def _completion_future(loop, task):
+    """asyncio future resolved from any thread when task completes"""
+    future = loop.create_future()
+
+    def set_done():
+        if not future.done():
+            future.set_result(task)
+
+    def callback(_):
+        try:
+            loop.call_soon_threadsafe(set_done)
+        except RuntimeError:
+            # Event loop closed in the meantime
+            pass
+
+    task.add_done_callback(callback)
+    return future
+
+
+class AsyncTaskManagerMixin(object):
+    """Awaitable variants of the TaskManager blocking methods
+
+    Completion of the AsyncResults is bridged into the event loop without
+    any thread: the AsyncResults with completion callbacks resolve asyncio
+    futures through call_soon_threadsafe, and the older AsyncResults and the
+    tasks still queued on the client are checked by a single coroutine that
+    polls the backend once per tick and otherwise yields to the event loop.
+    """
+
+    def _task_result(self, task):
+        """Result of a completed task as exposed to the consumers"""
+        return task.get()
+
+    async def _run_in_executor(self, method, *args, **kwargs):
+        """Run a blocking method in an executor thread"""
+        lock = _client_lock(self)
+
+        def locked_call():
+            with lock:
+                return method(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, locked_call)
+
+    async def as_completed_async(self, poll_interval=0.01):
+        """Asynchronously iterate over the tasks as soon as they complete"""
+        loop = asyncio.get_running_loop()
+        lock = _client_lock(self)
+        while not lock.acquire(False):
+            await asyncio.sleep(poll_interval)
+        try:
+            pending = set(self.pending_tasks())
+            all_tasks = self.all_tasks(skip_aborted=True)
+            completed = [t for t in all_tasks
+                         if t not in pending and t.ready()]
+            n_total = self.total()
+        finally:
+            lock.release()
+        seen = pending.union(all_tasks)
+        for task in completed:
+            yield task
+
+        futures = {}
+        polled = set()
+
+        def watch(tasks):
+            for task in tasks:
+                if task_attempts(task) and hasattr(task, 'add_done_callback'):
+                    futures[_completion_future(loop, task)] = task
+                else:
+                    polled.add(task)
+
+        watch(pending)
+        while futures or polled or self._launching():
+            # Only wake up periodically if something has to be polled
+            timeout = None
+            if (polled or self._launching()
+                    or self.speculative_factor is not None):
+                timeout = poll_interval
+            finished = []
+            if futures:
+                done, _ = await asyncio.wait(
+                    list(futures), timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                finished = [futures.pop(f) for f in done]
+            else:
+                await asyncio.sleep(poll_interval)
+
+            if lock.acquire(False):
+                # Skip this tick if a launch is currently using the client
+                try:
+                    self._fill_window()
+                    if self.total() != n_total:
+                        # Tasks launched in the meantime by an adaptive
+                        # launcher
+                        n_total = self.total()
+                        new_tasks = [
+                            t for t in self.all_tasks(skip_aborted=False)
+                            if t not in seen]
+                        seen.update(new_tasks)
+                        watch(new_tasks)
+                    sent = [t for t in polled if task_attempts(t)]
+                    polled.difference_update(sent)
+                    watch(sent)
+                    sent = [t for t in polled if task_attempts(t)]
+                    done = self.backend.wait(sent, timeout=0) if sent else []
+                    # Tasks aborted while queued on the client
+                    done += [t for t in polled
+                             if not task_attempts(t) and t.ready()]
+                    for task in done:
+                        polled.discard(task)
+                        task.ready()  # fetch the result or the exception
+                        finished.append(task)
+                    self._maybe_speculate()
+                finally:
+                    lock.release()
+
+            for task in finished:
+                self._task_done(task)
+                if not is_aborted(task):
+                    yield task
+
+    async def results(self, poll_interval=0.01):
+        """Asynchronously iterate over the results of the completed tasks"""
+        async for task in self.as_completed_async(poll_interval=poll_interval):
+            yield self._task_result(task)
+
+    async def wait_async(self, poll_interval=0.01):
+        """Wait for all the tasks without blocking the event loop"""
+        async for _ in self.as_completed_async(poll_interval=poll_interval):
+            pass
+        return self
@@ -0,0 +1,516 @@
+"""Execution backends for the task managers
+
+Author: Pyrallel contributors
+Licensed: MIT
+"""
+import os
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from multiprocessing import Queue
+from multiprocessing import cpu_count
+from time import sleep
+from time import time
+try:
+    from queue import Empty
+except ImportError:
+    # Python 2
+    from Queue import Empty
+try:
+    from concurrent.futures import FIRST_COMPLETED
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures import wait as wait_futures
+except ImportError:
+    # Python 2 without the futures backport: only the IPython backend is
+    # available
+    ProcessPoolExecutor = None
+
+from IPython.parallel import TaskAborted
+from IPython.parallel import error
+from IPython.utils.pickleutil import can
+from IPython.utils.pickleutil import can_dict
+from IPython.utils.pickleutil import can_sequence
+from IPython.utils.pickleutil import uncan
+from IPython.utils.pickleutil import uncan_dict
+from IPython.utils.pickleutil import uncan_sequence
+
+from pyrallel.common import get_topology
+from pyrallel.common import task_attempts
+from pyrallel.dataset_cache import DatasetCache
+from pyrallel.mmap_utils import digest_filename
+from pyrallel.mmap_utils import dump_payload
+from pyrallel.mmap_utils import file_sizes
+from pyrallel.mmap_utils import host_dump
+from pyrallel.mmap_utils import host_file_sizes
+from pyrallel.mmap_utils import host_unlink
+from pyrallel.mmap_utils import is_shm_filename
+from pyrallel.mmap_utils import load_in_memory
+from pyrallel.mmap_utils import persist_cv_splits
+from pyrallel.mmap_utils import persist_cv_splits_on_hosts
+from pyrallel.mmap_utils import shm_folder
+from pyrallel.mmap_utils import unlink_files
+from pyrallel.mmap_utils import warm_mmap
+
+
+STORAGES = ('disk', 'shm')
+
+# Number of task managers using each file removed on reset, for the local
+# host and for the hosts of each IPython client: several managers can use
+# the same digest named files
+_local_file_users = {}
+_client_file_users = weakref.WeakKeyDictionary()
+_file_users_lock = threading.Lock()
+
+
+def _check_storage(storage):
+    if storage not in STORAGES:
+        raise ValueError("storage should be one of %r, got %r"
+                         % (STORAGES, storage))
+    return storage
+
+
+class Backend(object):
+    """Interface of the task execution backends
+
+    ``apply`` returns AsyncResult-like objects with the ``ready``, ``wait``,
+    ``get``, ``abort``, ``elapsed`` and ``msg_ids`` members of the IPython
+    AsyncResult.
+
+    ``thread_safe`` backends accept new tasks from the completion callbacks
+    of the previous ones.
+
+    With ``storage='shm'`` the data files are stored in the shared memory of
+    the hosts instead of the folder requested by the task managers: they are
+    never written to nor read from disk and all the workers of a host memory
+    map the same pages. Such files only live as long as the task managers
+    using them: they are removed when the last one is reset.
+
+    The other data files dumped on the hosts are registered in the
+    ``dataset_cache`` of the backend that evicts the least recently used
+    ones beyond its byte budget.
+    """
+
+    thread_safe = False
+    storage = 'disk'
+    dataset_cache = None
+
+    def apply(self, f, *args, **kwargs):
+        raise NotImplementedError()
+
+    def apply_local(self, data_filename, f, *args, **kwargs):
+        """Apply f, preferably on a worker where data_filename is warm"""
+        return self.apply(f, *args, **kwargs)
+
+    def wait(self, tasks, timeout=None):
+        """Wait for at least one task, return the list of completed ones"""
+        raise NotImplementedError()
+
+    def spin(self):
+        pass
+
+    def record_starts(self, tasks):
+        """Record the start time of the tasks that started running
+
+        Backends whose AsyncResults do not expose when they started set
+        their ``started`` attribute to the time they are first seen
+        running.
+        """
+        pass
+
+    def n_workers(self):
+        raise NotImplementedError()
+
+    def host_dump(self, payload, target_filename, pre_warm=True,
+                  digest=None):
+        """Make payload available under target_filename to all workers
+
+        If the content digest of payload is given, existing files with a
+        different recorded digest are replaced.
+        """
+        raise NotImplementedError()
+
+    def warm_mmap(self, data_filenames):
+        """Load the arrays of data_filenames in the OS page cache
+
+        Return a dict mapping each host to its warm-up statistics.
+        """
+        raise NotImplementedError()
+
+    def host_unlink(self, filenames):
+        """Remove filenames from all the hosts of the workers"""
+        raise NotImplementedError()
+
+    def _file_users(self):
+        return _local_file_users
+
+    def acquire_host_files(self, filenames):
+        """Register one more task manager using filenames on the hosts"""
+        with _file_users_lock:
+            users = self._file_users()
+            for filename in filenames:
+                users[filename] = users.get(filename, 0) + 1
+
+    def release_host_files(self, filenames):
+        """Unregister a user of filenames and remove the unused ones
+
+        Return the list of removed filenames.
+        """
+        unused = []
+        with _file_users_lock:
+            users = self._file_users()
+            for filename in filenames:
+                n_users = users.pop(filename, 1) - 1
+                if n_users > 0:
+                    users[filename] = n_users
+                else:
+                    unused.append(filename)
+        if unused:
+            self.host_unlink(unused)
+        return unused
+
+    def file_sizes(self, filenames):
+        """Return a dict mapping each host to the sizes of filenames there"""
+        raise NotImplementedError()
+
+    def data_folder(self, folder):
+        """Folder where the data files meant for folder are to be stored"""
+        if self.storage == 'shm':
+            return shm_folder()
+        return folder
+
+    def persist_cv_splits(self, X, y, **kwargs):
+        """Persist CV splits of X, y where the workers can load them"""
+        return persist_cv_splits(X, y, **kwargs)
+
+
+class IPythonBackend(Backend):
+    """Run the tasks on an IPython.parallel load balanced view
+
+    apply_local restricts the load balancing to the engines of the hosts
+    where the data file has been warmed by warm_mmap as long as they have
+    less than ``slots_per_engine`` such tasks in flight each. Beyond that the
+    tasks are scheduled on any engine.
+
+    broadcast and stream are passed to host_dump to select how the data
+    files are distributed to the hosts.
+
+    cache_bytes is the budget in bytes of the data files kept on each host
+    by the dataset cache (unlimited if None).
+    """
+
+    def __init__(self, load_balanced_view, slots_per_engine=2,
+                 broadcast='client', stream=False, storage='disk',
+                 cache_bytes=None):
+        self.storage = _check_storage(storage)
+        self.dataset_cache = DatasetCache(self, max_bytes=cache_bytes)
+        self.view = load_balanced_view
+        self.client = load_balanced_view.client
+        self.topology = get_topology(self.client)
+        self.slots_per_engine = slots_per_engine
+        self.broadcast = broadcast
+        self.stream = stream
+        self._routed = {}
+
+    def apply(self, f, *args, **kwargs):
+        return self.view.apply(f, *args, **kwargs)
+
+    def apply_local(self, data_filename, f, *args, **kwargs):
+        engine_ids = self.topology.warm_engines(data_filename)
+        if not engine_ids or len(engine_ids) == len(self.client.ids):
+            # Unknown locality or warm everywhere: nothing to prefer
+            return self.apply(f, *args, **kwargs)
+
+        key = frozenset(engine_ids)
+        outstanding = self.client.outstanding
+        routed = [task for task in self._routed.get(key, ())
+                  if not outstanding.isdisjoint(task.msg_ids)]
+        if len(routed) >= self.slots_per_engine * len(engine_ids):
+            # Warm hosts are saturated: fall back to any engine
+            self._routed[key] = routed
+            return self.apply(f, *args, **kwargs)
+
+        with self.view.temp_flags(targets=engine_ids):
+            task = self.view.apply(f, *args, **kwargs)
+        routed.append(task)
+        self._routed[key] = routed
+        return task
+
+    def wait(self, tasks, timeout=None, poll_interval=0.001,
+             max_poll_interval=0.05):
+        # client.wait returns once all the messages are done: poll for the
+        # first completion instead, backing off while nothing completes
+        attempts = [(task, [a.msg_ids for a in task_attempts(task)])
+                    for task in tasks]
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            self.client.spin()
+            outstanding = self.client.outstanding
+            done = [task for task, msg_ids in attempts
+                    if any(outstanding.isdisjoint(ids) for ids in msg_ids)]
+            if done or (deadline is not None and time() >= deadline):
+                return done
+            wait_time = poll_interval
+            if deadline is not None:
+                wait_time = min(wait_time, max(deadline - time(), 0.0))
+            sleep(wait_time)
+            poll_interval = min(2 * poll_interval, max_poll_interval)
+
+    def spin(self):
+        self.view.spin()
+
+    def record_starts(self, tasks):
+        # IPython only reports the start date of the completed tasks. The
+        # scheduler sends a task to an engine once the previous one is done
+        # (default high water mark of 1), so the tasks assigned to an engine
+        # are the running ones.
+        tasks = [task for task in tasks
+                 if getattr(task, 'started', None) is None]
+        if not tasks:
+            return
+        status = self.client.queue_status(verbose=True)
+        running = set(msg_id for engine_id, engine_status in status.items()
+                      if engine_id != 'unassigned'
+                      for msg_id in engine_status.get('tasks', ()))
+        now = time()
+        for task in tasks:
+            if not running.isdisjoint(task.msg_ids):
+                task.started = now
+
+    def n_workers(self):
+        return len(self.client.ids)
+
+    def host_dump(self, payload, target_filename, pre_warm=True,
+                  digest=None):
+        host_dump(self.client, payload, target_filename, pre_warm=pre_warm,
+                  broadcast=self.broadcast, stream=self.stream, digest=digest)
+
+    def warm_mmap(self, data_filenames):
+        return warm_mmap(self.client, data_filenames)
+
+    def host_unlink(self, filenames):
+        host_unlink(self.client, filenames)
+
+    def _file_users(self):
+        users = _client_file_users.get(self.client)
+        if users is None:
+            users = _client_file_users[self.client] = {}
+        return users
+
+    def file_sizes(self, filenames):
+        return host_file_sizes(self.client, filenames)
+
+    def persist_cv_splits(self, X, y, **kwargs):
+        return persist_cv_splits_on_hosts(
+            self.client, X, y, broadcast=self.broadcast, stream=self.stream,
+            **kwargs)
+
+
+# Queue where the worker processes of a LocalBackend report the start of
+# each task
+_start_queue = None
+
+
+def _init_worker(start_queue):
+    global _start_queue
+    _start_queue = start_queue
+
+
+def _call_canned(msg_id, canned_f, args, kwargs):
+    # Functions decorated with @interactive live in __main__ and cannot be
+    # pickled by reference: they are shipped by value as for IPython engines.
+    started = time()
+    if _start_queue is not None:
+        _start_queue.put((msg_id, started))
+    namespace = globals()
+    f = uncan(canned_f, namespace)
+    args = uncan_sequence(args, namespace)
+    kwargs = uncan_dict(kwargs, namespace)
+    return started, f(*args, **kwargs)
+
+
+class LocalAsyncResult(object):
+    """AsyncResult-like wrapper for a concurrent.futures Future"""
+
+    def __init__(self, future, msg_id=None, submitted=None):
+        self._future = future
+        self._exception = None
+        self._submitted = time() if submitted is None else submitted
+        self._started = None
+        self._completed = None
+        self.msg_ids = [uuid.uuid4().hex if msg_id is None else msg_id]
+        # Registered first so that _exception is set before any other
+        # completion callback is called
+        future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        self._completed = time()
+        if future.cancelled():
+            self._exception = TaskAborted(self.msg_ids[0])
+        else:
+            self._exception = future.exception()
+            if self._exception is None:
+                self._started = future.result()[0]
+
+    @property
+    def started(self):
+        """Start time of the task, None if not known to have started
+
+        Running tasks are known to have started once reported by
+        LocalBackend.record_starts.
+        """
+        return self._started
+
+    @property
+    def completed(self):
+        return self._completed
+
+    def add_done_callback(self, callback):
+        self._future.add_done_callback(lambda future: callback(self))
+
+    @property
+    def elapsed(self):
+        end = self._completed if self._completed is not None else time()
+        return end - self._submitted
+
+    def ready(self):
+        return self._future.done()
+
+    def successful(self):
+        assert self.ready()
+        return self._exception is None
+
+    def wait(self, timeout=-1):
+        if timeout is not None and timeout < 0:
+            timeout = None
+        wait_futures([self._future], timeout=timeout)
+
+    def get(self, timeout=-1):
+        self.wait(timeout)
+        if not self.ready():
+            raise error.TimeoutError("Result not ready.")
+        if self._exception is not None:
+            raise self._exception
+        return self._future.result()[1]
+
+    def abort(self):
+        # As with IPython, only the tasks that have not started yet can be
+        # aborted: running tasks are left to complete.
+        assert not self.ready(), "Can't abort, result is already ready"
+        self._future.cancel()
+
+
+def _has_digest(filename, digest):
+    if digest is None:
+        return True
+    try:
+        with open(digest_filename(filename)) as f:
+            return f.read().strip() == digest
+    except IOError:
+        return False
+
+
+class LocalBackend(Backend):
+    """Run the tasks in a pool of local processes
+
+    Useful for single host runs and benchmarks: there is no controller,
+    hub or ZeroMQ hop and the data files are written once to the local
+    filesystem where all the worker processes memory map them directly.
+
+    Requires concurrent.futures (the futures backport under Python 2). The
+    start of the running tasks is only reported by the workers of executors
+    supporting an initializer (Python 3.7+): otherwise the tasks are only
+    known to have started once completed.
+    """
+
+    thread_safe = True
+
+    def __init__(self, max_workers=None, storage='disk', cache_bytes=None):
+        self.storage = _check_storage(storage)
+        self.dataset_cache = DatasetCache(self, max_bytes=cache_bytes)
+        if max_workers is None:
+            max_workers = cpu_count()
+        if ProcessPoolExecutor is None:
+            raise ImportError("LocalBackend requires concurrent.futures,"
+                              " install the futures backport under Python 2")
+        self.max_workers = max_workers
+        self._start_queue = Queue()
+        self._start_times = OrderedDict()
+        try:
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker,
+                initargs=(self._start_queue,))
+        except TypeError:
+            # No worker initializer before Python 3.7
+            self._start_queue = None
+            self.executor = ProcessPoolExecutor(max_workers=max_workers)
+
+    def apply(self, f, *args, **kwargs):
+        msg_id = uuid.uuid4().hex
+        # Recorded before the task can start on a worker
+        submitted = time()
+        future = self.executor.submit(_call_canned, msg_id, can(f),
+                                      can_sequence(args), can_dict(kwargs))
+        return LocalAsyncResult(future, msg_id, submitted=submitted)
+
+    def record_starts(self, tasks):
+        if self._start_queue is None:
+            return
+        while not self._start_queue.empty():
+            try:
+                msg_id, started = self._start_queue.get_nowait()
+            except Empty:
+                break
+            self._start_times[msg_id] = started
+        for task in tasks:
+            started = self._start_times.pop(task.msg_ids[0], None)
+            if started is not None and task._started is None:
+                task._started = started
+        while len(self._start_times) > 10 * self.max_workers:
+            # The oldest starts are the ones of tasks completed by now
+            self._start_times.popitem(last=False)
+
+    def wait(self, tasks, timeout=None):
+        futures = set(attempt._future for task in tasks
+                      for attempt in task_attempts(task))
+        done, _ = wait_futures(futures, timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+        return [task for task in tasks
+                if any(attempt._future in done
+                       for attempt in task_attempts(task))]
+
+    def n_workers(self):
+        return self.max_workers
+
+    def host_dump(self, payload, target_filename, pre_warm=True,
+                  digest=None):
+        if (not os.path.exists(target_filename)
+                or not _has_digest(target_filename, digest)):
+            dump_payload(payload, target_filename, digest=digest)
+        if pre_warm:
+            self.warm_mmap([target_filename])
+
+    def warm_mmap(self, data_filenames):
+        data_filenames = [os.path.abspath(f) for f in data_filenames
+                          if not is_shm_filename(f)]
+        if not data_filenames:
+            return {}
+        stats = load_in_memory(data_filenames)
+        return {stats['host']: stats}
+
+    def host_unlink(self, filenames):
+        unlink_files([os.path.abspath(f) for f in filenames])
+
+    def file_sizes(self, filenames):
+        host, sizes = file_sizes([os.path.abspath(f) for f in filenames])
+        return {host: sizes}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+def get_backend(view_or_backend):
+    """Wrap an IPython load balanced view as a Backend if needed"""
+    if isinstance(view_or_backend, Backend):
+        return view_or_backend
+    return IPythonBackend(view_or_backend)
@@ -4,7 +4,16 @@ Author: Olivier Grisel <olivier@ogrisel.com>
 Licensed: MIT
 """
 
+import threading
+import weakref
+from collections import deque
+from datetime import datetime
+from time import sleep
+from time import time
+
+import numpy as np
 from IPython.parallel import TaskAborted
+from IPython.parallel import error
 from IPython.parallel import interactive
 
 
@@ -12,8 +21,595 @@ def is_aborted(task):
     return isinstance(getattr(task, '_exception', None), TaskAborted)
 
 
+def task_attempts(task):
+    """Return the underlying AsyncResults that can complete task"""
+    attempts = getattr(task, 'attempts', None)
+    return [task] if attempts is None else attempts
+
+
+def running_time(task):
+    """Seconds spent by task running on a worker, None if not started yet
+
+    Unlike elapsed, the time spent waiting in the queues before the start
+    of the execution is not accounted for.
+    """
+    metadata = getattr(task, 'metadata', None) or {}
+    if metadata.get('started') is not None:
+        # IPython records the start and completion dates of the tasks
+        completed = metadata.get('completed') or datetime.now()
+        return (completed - metadata['started']).total_seconds()
+    started = getattr(task, 'started', None)
+    if started is None:
+        return None
+    completed = getattr(task, 'completed', None)
+    return (time() if completed is None else completed) - started
+
+
+@interactive
+def run_batch(f, batch):
+    """Call f for each (args, kwargs) pair of batch
+
+    Return the (result, exception) pair of each call: a failing call does
+    not fail the other calls of the batch.
+    """
+    outcomes = []
+    for args, kwargs in batch:
+        try:
+            outcomes.append((f(*args, **kwargs), None))
+        except Exception as e:
+            outcomes.append((None, e))
+    return outcomes
+
+
+class BatchItem(object):
+    """AsyncResult-like proxy for one of the results of a run_batch task
+
+    The exception raised by its own call, if any, is raised by ``get``.
+    All the other attributes are delegated to the batch AsyncResult.
+    """
+
+    def __init__(self, task, index):
+        self._task = task
+        self._index = index
+
+    def __getattr__(self, name):
+        return getattr(self._task, name)
+
+    @property
+    def add_done_callback(self):
+        # Raise AttributeError if the batch task does not support callbacks
+        add_done_callback = self._task.add_done_callback
+        return lambda callback: add_done_callback(lambda _: callback(self))
+
+    def successful(self):
+        if not self._task.successful():
+            return False
+        return self._task.get()[self._index][1] is None
+
+    def get(self, timeout=-1):
+        result, exception = self._task.get(timeout)[self._index]
+        if exception is not None:
+            raise exception
+        return result
+
+
+class TaskProxyTimings(object):
+    """Timing attributes of an AsyncResult-like proxy
+
+    They are read from the ``_timed_task`` of the proxy, the AsyncResult
+    that actually runs the task or None if it has not been submitted yet.
+    """
+
+    @property
+    def elapsed(self):
+        task = self._timed_task
+        return 0.0 if task is None else task.elapsed
+
+    @property
+    def metadata(self):
+        return getattr(self._timed_task, 'metadata', None)
+
+    @property
+    def _submitted(self):
+        return getattr(self._timed_task, '_submitted', None)
+
+    @property
+    def started(self):
+        return getattr(self._timed_task, 'started', None)
+
+    @property
+    def completed(self):
+        return getattr(self._timed_task, 'completed', None)
+
+
+class SpeculativeTask(TaskProxyTimings):
+    """AsyncResult-like proxy for a task that can be launched several times
+
+    The first attempt to complete wins: the other attempts are aborted (or
+    ignored if they are already running).
+    """
+
+    def __init__(self, launch):
+        self._launch = launch
+        self._lock = threading.Lock()
+        self._winner = None
+        self._callbacks = []
+        self.attempts = []
+        self.speculate()
+
+    def speculate(self):
+        """Launch a new attempt of the task"""
+        attempt = self._launch()
+        self.attempts.append(attempt)
+        if hasattr(attempt, 'add_done_callback'):
+            attempt.add_done_callback(self._attempt_done)
+        return attempt
+
+    def _attempt_done(self, attempt):
+        with self._lock:
+            if self._winner is not None:
+                return
+            self._winner = attempt
+            callbacks = self._callbacks[:]
+        for other in self.attempts:
+            if other is not attempt and not other.ready():
+                try:
+                    other.abort()
+                except AssertionError:
+                    pass
+        for callback in callbacks:
+            callback(self)
+
+    @property
+    def add_done_callback(self):
+        if not hasattr(self.attempts[0], 'add_done_callback'):
+            raise AttributeError('add_done_callback')
+        return self._add_done_callback
+
+    def _add_done_callback(self, callback):
+        with self._lock:
+            if self._winner is None:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    @property
+    def msg_ids(self):
+        return [msg_id for a in self.attempts for msg_id in a.msg_ids]
+
+    @property
+    def _timed_task(self):
+        if self._winner is not None:
+            return self._winner
+        return self.attempts[0]
+
+    @property
+    def _exception(self):
+        return getattr(self._winner, '_exception', None)
+
+    def ready(self):
+        if self._winner is None:
+            for attempt in self.attempts[:]:
+                if attempt.ready():
+                    self._attempt_done(attempt)
+                    break
+        return self._winner is not None
+
+    def wait(self, timeout=-1, poll_interval=0.01):
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = time() + timeout
+        while not self.ready():
+            if deadline is not None and time() >= deadline:
+                return
+            if len(self.attempts) == 1:
+                self.attempts[0].wait(poll_interval)
+            else:
+                for attempt in self.attempts[:]:
+                    attempt.wait(poll_interval / len(self.attempts))
+
+    def get(self, timeout=-1):
+        self.wait(timeout)
+        if self._winner is None:
+            raise error.TimeoutError("Result not ready.")
+        return self._winner.get()
+
+    def abort(self):
+        for attempt in self.attempts:
+            if not attempt.ready():
+                attempt.abort()
+
+
+class DeferredTask(TaskProxyTimings):
+    """AsyncResult-like placeholder for a task held in the submission queue
+
+    The task is actually submitted by the manager when a slot of the
+    submission window is available. Aborting it before that point simply
+    drops it from the queue.
+
+    ``items`` are the tasks tracked by the manager in its place: the
+    deferred task itself or the BatchItems of a batch.
+    """
+
+    def __init__(self, manager, launch):
+        self._manager = manager
+        self._launch = launch
+        self._task = None
+        self._aborted = False
+        self._released = False
+        self.items = [self]
+
+    @property
+    def bound(self):
+        return self._task is not None
+
+    def bind(self):
+        self._task = self._launch()
+        return self._task
+
+    @property
+    def attempts(self):
+        return task_attempts(self._task) if self.bound else []
+
+    @property
+    def add_done_callback(self):
+        # Only available once sent, if the task of the backend supports it
+        add_done_callback = self._task.add_done_callback
+        return lambda callback: add_done_callback(lambda _: callback(self))
+
+    @property
+    def msg_ids(self):
+        return self._task.msg_ids if self.bound else []
+
+    @property
+    def _timed_task(self):
+        return self._task
+
+    @property
+    def _exception(self):
+        if self._aborted:
+            return TaskAborted()
+        return getattr(self._task, '_exception', None)
+
+    def ready(self):
+        return self._aborted or (self.bound and self._task.ready())
+
+    def wait(self, timeout=-1, poll_interval=0.01):
+        deadline = None
+        if timeout is not None and timeout >= 0:
+            deadline = time() + timeout
+        while not self.bound and not self._aborted:
+            if deadline is not None and time() >= deadline:
+                return
+            # Let the manager refill its submission window
+            self._manager._poll()
+            sleep(poll_interval)
+        if self.bound:
+            if deadline is not None:
+                timeout = max(deadline - time(), 0.0)
+            self._task.wait(timeout)
+
+    def get(self, timeout=-1):
+        self.wait(timeout)
+        if self._aborted:
+            raise self._exception
+        if not self.bound:
+            raise error.TimeoutError("Result not ready.")
+        return self._task.get()
+
+    def abort(self):
+        if self.bound:
+            return self._task.abort()
+        self._aborted = True
+        for item in self.items:
+            self._manager._task_done(item)
+
+
+TIMINGS_DTYPE = [
+    ('engine_id', np.int64),
+    ('host', object),
+    ('pid', np.int64),
+    ('queue', np.float64),
+    ('load', np.float64),
+    ('fit', np.float64),
+    ('score', np.float64),
+    ('dump', np.float64),
+]
+
+
+def _queue_wait(task, metadata, started):
+    """Time between the submission of task and the start of its execution"""
+    submitted = metadata.get('submitted')
+    if submitted is not None and metadata.get('started') is not None:
+        # IPython records the submission and start dates of each task
+        return (metadata['started'] - submitted).total_seconds()
+    submitted = getattr(task, '_submitted', None)
+    if submitted is None:
+        return np.nan
+    if getattr(task, 'started', None) is not None:
+        # Start of the whole task: the calls of a batch that ran before the
+        # one of task are not spent waiting in the queue
+        started = task.started
+    return started - submitted
+
+
 class TaskManager(object):
-    """Base class for managing tasks and groups of tasks"""
+    """Base class for managing tasks and groups of tasks
+
+    Subclasses register each new task with ``_track`` and call
+    ``_reset_counters`` whenever they forget about their previous tasks.
+    Completion is accounted for incrementally so that progress queries do not
+    have to rescan every task ever submitted. Subclasses that do not call
+    ``TaskManager.__init__`` or that add tasks to ``tasks`` or
+    ``task_groups`` without ``_track`` are still supported by scanning
+    ``all_tasks`` instead.
+
+    Speculative re-execution of stragglers is enabled by setting
+    ``speculative_factor``: a task submitted with ``_submit`` that runs
+    longer than that multiple of the median running time of the completed
+    tasks of its group gets a duplicate launched on the backend and the
+    first copy to complete is used.
+
+    Setting ``max_in_flight_per_worker`` bounds the number of tasks sent to
+    the backend: the other tasks submitted with ``_submit`` are held in a
+    client side queue as DeferredTask placeholders and sent as the in-flight
+    tasks complete. Queued tasks can still be reordered with ``prioritize``
+    or dropped with ``abort``.
+    """
+
+    speculative_factor = None
+    speculative_min_completed = 3
+    speculative_interval = 1.0
+    max_in_flight_per_worker = None
+
+    def __init__(self):
+        self._counter_lock = threading.Lock()
+        self._reset_counters()
+
+    def _reset_counters(self):
+        with self._counter_lock:
+            self._pending = set()
+            self._polled = set()
+            self._n_total = 0
+            self._n_completed = 0
+            self._n_aborted = 0
+            self._speculation_groups = {}
+            self._last_speculation = time()
+            self._queue = deque()
+            self._n_in_flight = 0
+
+    def _track(self, task, watch=True):
+        """Register a newly submitted task and return it
+
+        Tasks still held in the submission queue are only watched once sent
+        to the backend.
+        """
+        with self._counter_lock:
+            self._pending.add(task)
+            self._n_total += 1
+        if watch:
+            self._watch(task)
+        return task
+
+    def _counted(self):
+        """True if the counters account for all the tasks of the manager"""
+        if getattr(self, '_counter_lock', None) is None:
+            return False
+        n_tasks = len(getattr(self, 'tasks', ()))
+        n_tasks += sum(len(task_group) for task_group
+                       in getattr(self, 'task_groups', ()))
+        return n_tasks <= self._n_total
+
+    def _watch(self, task, source=None):
+        """Account for task as done when source completes"""
+        if source is None:
+            source = task
+        if hasattr(source, 'add_done_callback'):
+            source.add_done_callback(lambda _: self._task_done(task))
+        else:
+            # Old style AsyncResult without completion callbacks: completion
+            # will be detected lazily by _poll.
+            with self._counter_lock:
+                self._polled.add(task)
+
+    def _submit(self, f, args=(), kwargs=None, data_filename=None,
+                group=None):
+        """Apply f on the backend and track the resulting task
+
+        If data_filename is given, the task is preferably scheduled on a
+        worker where that file is warm. Tasks of the same group are expected
+        to have comparable running times for the straggler detection.
+        """
+        return self._submit_items(f, args, kwargs, data_filename, group)[0]
+
+    def _submit_items(self, f, args=(), kwargs=None, data_filename=None,
+                      group=None, make_items=None):
+        """Apply f on the backend and track the resulting items
+
+        make_items maps the task to the list of the AsyncResult-like items
+        to track in its place, by default the task itself. The task goes
+        through the submission window and the straggler detection.
+        """
+        if kwargs is None:
+            kwargs = {}
+
+        def launch():
+            if data_filename is None:
+                return self.backend.apply(f, *args, **kwargs)
+            return self.backend.apply_local(data_filename, f, *args, **kwargs)
+
+        def make_task():
+            if self.speculative_factor is None:
+                return launch()
+            task = SpeculativeTask(launch)
+            # Also called from the completion callbacks of thread safe
+            # backends while speculate iterates over the groups
+            with self._counter_lock:
+                group_state = self._speculation_groups.setdefault(
+                    group, {'pending': set(), 'durations': []})
+                group_state['pending'].add(task)
+            return task
+
+        if self.max_in_flight_per_worker is None:
+            task = self._use_data(data_filename, make_task())
+            items = [task] if make_items is None else make_items(task)
+            return [self._track(item) for item in items]
+
+        deferred = self._use_data(data_filename, DeferredTask(self, make_task))
+        if make_items is not None:
+            deferred.items = make_items(deferred)
+        items = [self._track(item, watch=False) for item in deferred.items]
+        with self._counter_lock:
+            self._queue.append(deferred)
+        self._fill_window()
+        return items
+
+    def _use_data(self, data_filename, task):
+        """Pin the dataset of data_filename in the cache until task is done"""
+        cache = getattr(self.backend, 'dataset_cache', None)
+        if data_filename is not None and cache is not None:
+            cache.use(data_filename, task)
+        return task
+
+    def _launching(self):
+        """True if more tasks are to be launched as the current ones complete
+
+        Adaptive launchers that decide on the next tasks from the results of
+        the previous ones override this and launch their tasks from
+        _fill_window.
+        """
+        return False
+
+    def _fill_window(self):
+        """Send queued tasks to the backend while the window has room"""
+        if self.max_in_flight_per_worker is None:
+            return
+        limit = max(1, self.max_in_flight_per_worker
+                    * self.backend.n_workers())
+        while True:
+            with self._counter_lock:
+                if self._n_in_flight >= limit or not self._queue:
+                    return
+                deferred = self._queue.popleft()
+                if deferred.ready():
+                    # Aborted while queued
+                    continue
+                self._n_in_flight += 1
+            task = deferred.bind()
+            for item in deferred.items:
+                self._watch(item, task)
+
+    def queued(self):
+        """Number of tasks held in the client side submission queue"""
+        return len(self._queue)
+
+    def prioritize(self, key):
+        """Reorder the queued tasks by increasing key(deferred_task)"""
+        with self._counter_lock:
+            self._queue = deque(sorted(self._queue, key=key))
+        return self
+
+    def speculate(self):
+        """Launch a duplicate of the straggling tasks of each group
+
+        Return the number of duplicates launched.
+        """
+        n_launched = 0
+        with self._counter_lock:
+            groups = [(group_state, list(group_state['pending']))
+                      for group_state in self._speculation_groups.values()]
+        for group_state, pending in groups:
+            durations = group_state['durations']
+            done = set(task for task in pending if task.ready())
+            with self._counter_lock:
+                group_state['pending'].difference_update(done)
+            for task in done:
+                duration = None
+                if not is_aborted(task):
+                    duration = running_time(task)
+                if duration is not None:
+                    durations.append(duration)
+            pending = [task for task in pending if task not in done]
+            if not pending or len(durations) < self.speculative_min_completed:
+                continue
+
+            # Only the tasks that have started can be straggling: the other
+            # ones are still waiting in the queues
+            attempts = [task.attempts[0] for task in pending
+                        if len(task.attempts) == 1]
+            self.backend.record_starts(attempts)
+            threshold = self.speculative_factor * np.median(durations)
+            for task in pending:
+                if len(task.attempts) != 1:
+                    continue
+                duration = running_time(task.attempts[0])
+                if duration is not None and duration > threshold:
+                    task.speculate()
+                    n_launched += 1
+        self._last_speculation = time()
+        return n_launched
+
+    def _maybe_speculate(self):
+        if self.speculative_factor is None:
+            return
+        if time() - self._last_speculation > self.speculative_interval:
+            self.speculate()
+
+    def _submit_batch(self, f, batch, data_filename=None, group=None):
+        """Run f on each (args, kwargs) pair of batch in a single task
+
+        Return one tracked BatchItem per call so that the batch is
+        accounted as individual tasks.
+        """
+        return self._submit_items(
+            run_batch, (f, batch), data_filename=data_filename, group=group,
+            make_items=lambda task: [BatchItem(task, i)
+                                     for i in range(len(batch))])
+
+    def _auto_chunk_size(self, n_tasks, chunks_per_worker=4):
+        """Batch size giving a few batches per worker for load balancing"""
+        n_workers = max(self.backend.n_workers(), 1)
+        return max(1, n_tasks // (chunks_per_worker * n_workers))
+
+    def _task_done(self, task):
+        if getattr(self, '_counter_lock', None) is None:
+            return
+        with self._counter_lock:
+            if task not in self._pending:
+                # Stale task from before the last reset or already accounted
+                return
+            self._pending.discard(task)
+            self._polled.discard(task)
+            if is_aborted(task):
+                self._n_aborted += 1
+            else:
+                self._n_completed += 1
+            deferred = task
+            if isinstance(task, BatchItem):
+                deferred = task._task
+            if (isinstance(deferred, DeferredTask) and deferred.bound
+                    and not deferred._released):
+                # The first item to complete releases the slot of the task
+                deferred._released = True
+                self._n_in_flight -= 1
+        if self.backend.thread_safe:
+            self._fill_window()
+
+    def _poll(self):
+        """Account for the tasks that cannot notify their completion
+
+        The backend is asked once for the completed ones instead of
+        querying each task.
+        """
+        if getattr(self, '_counter_lock', None) is None:
+            return
+        with self._counter_lock:
+            polled = list(self._polled)
+        if polled:
+            for task in self.backend.wait(polled, timeout=0):
+                task.ready()  # fetch the result or the exception
+                self._task_done(task)
+        self._fill_window()
 
     def all_tasks(self, skip_aborted=True):
         all_tasks = []
@@ -28,11 +624,25 @@ class TaskManager(object):
 
         return all_tasks
 
+    def pending_tasks(self):
+        if not self._counted():
+            return [t for t in self.all_tasks(skip_aborted=True)
+                    if not t.ready()]
+        self._poll()
+        with self._counter_lock:
+            return list(self._pending)
+
     def map_tasks(self, f, skip_aborted=True):
         return map(f, self.all_tasks(skip_aborted=skip_aborted))
 
-    def abort(self):
-        for task in self.all_tasks(skip_aborted=True):
+    def abort(self, tasks=None):
+        """Abort the given tasks, all the pending ones by default
+
+        Tasks already running are left to complete.
+        """
+        if tasks is None:
+            tasks = self.pending_tasks()
+        for task in tasks:
             if not task.ready():
                 try:
                     task.abort()
@@ -41,20 +651,121 @@ class TaskManager(object):
         return self
 
     def wait(self):
-        self.map_tasks(lambda t: t.wait(), skip_aborted=True)
+        if not self._counted():
+            for task in self.all_tasks(skip_aborted=True):
+                task.wait()
+            return self
+        for _ in self.as_completed():
+            pass
         return self
 
+    def as_completed(self, timeout=None, poll_interval=0.01):
+        """Yield the non aborted tasks as soon as they complete
+
+        Tasks that are already complete are yielded first. The remaining
+        tasks are then awaited with a blocking wait on the execution backend
+        (the ``backend`` attribute of the subclasses) that returns as soon as
+        one of them completes, instead of one blocking wait per task in
+        submission order. The set of tasks awaited only shrinks as they
+        complete, besides the tasks launched in the meantime.
+
+        Raise TimeoutError if some tasks are still pending after ``timeout``
+        seconds.
+        """
+        pending = set(self.pending_tasks())
+        seen = set(pending)
+        n_total = self.total()
+        for task in self.all_tasks(skip_aborted=True):
+            seen.add(task)
+            if task not in pending and task.ready():
+                yield task
+
+        # Tasks held in the submission queue are awaited once sent
+        queued = set(task for task in pending if not task_attempts(task))
+        sent = pending - queued
+        deadline = None if timeout is None else time() + timeout
+        while pending or self._launching():
+            self._fill_window()
+            if self.total() != n_total:
+                # Tasks launched in the meantime by an adaptive launcher
+                n_total = self.total()
+                for task in self.all_tasks(skip_aborted=False):
+                    if task not in seen:
+                        seen.add(task)
+                        pending.add(task)
+                        if task_attempts(task):
+                            sent.add(task)
+                        else:
+                            queued.add(task)
+
+            finished = []
+            for task in [t for t in queued if t.ready() or task_attempts(t)]:
+                queued.discard(task)
+                if task_attempts(task):
+                    sent.add(task)
+                else:
+                    # Aborted while still in the submission queue
+                    finished.append(task)
+
+            # Block until the next completion unless the stragglers are to
+            # be checked in the meantime
+            wait_time = None
+            if self.speculative_factor is not None:
+                wait_time = self.speculative_interval
+            if deadline is not None:
+                remaining = max(deadline - time(), 0.0)
+                wait_time = (remaining if wait_time is None
+                             else min(wait_time, remaining))
+            if sent and not finished:
+                finished += self.backend.wait(list(sent), timeout=wait_time)
+            elif not finished:
+                # Nothing to wait for until an adaptive launcher submits
+                sleep(poll_interval if wait_time is None
+                      else min(poll_interval, wait_time))
+            self._maybe_speculate()
+
+            for task in finished:
+                pending.discard(task)
+                sent.discard(task)
+                task.ready()  # fetch the result or the exception
+                self._task_done(task)
+                if not is_aborted(task):
+                    yield task
+
+            if pending and deadline is not None and time() >= deadline:
+                raise error.TimeoutError(
+                    "%d tasks still pending after %0.3fs"
+                    % (len(pending), timeout))
+
     def completed_tasks(self):
         return [t for t in self.all_tasks(skip_aborted=True) if t.ready()]
 
     def completed(self):
-        return sum(self.map_tasks(lambda t: t.ready(), skip_aborted=True))
+        if not self._counted():
+            return len(self.completed_tasks())
+        self._poll()
+        return self._n_completed
+
+    def aborted(self):
+        if not self._counted():
+            return len([t for t in self.all_tasks(skip_aborted=False)
+                        if is_aborted(t)])
+        self._poll()
+        return self._n_aborted
+
+    def pending(self):
+        if not self._counted():
+            return len(self.pending_tasks())
+        self._poll()
+        return len(self._pending)
 
     def done(self):
-        return all(self.map_tasks(lambda t: t.ready(), skip_aborted=True))
+        return self.pending() == 0 and not self._launching()
 
     def total(self):
-        return sum(self.map_tasks(lambda t: 1, skip_aborted=False))
+        if not self._counted():
+            return len(self.all_tasks(skip_aborted=False))
+        return self._n_total
 
     def progress(self):
         c = self.completed()
@@ -63,6 +774,37 @@ class TaskManager(object):
         else:
             return float(c) / self.total()
 
+    def _task_timings(self, task):
+        """Return the dict of phase timings recorded by a completed task"""
+        return None
+
+    def timings(self):
+        """Phase timings of the completed tasks as a NumPy record array
+
+        Each record holds the engine id and the host and process id of the
+        worker, the time the task waited in the queue before starting and
+        the time spent loading (memory mapping) the data, fitting, scoring
+        and dumping results, all in seconds.
+        """
+        records = []
+        for task in self.completed_tasks():
+            try:
+                timings = self._task_timings(task)
+            except Exception:
+                # Failed task
+                continue
+            if timings is None:
+                continue
+            metadata = getattr(task, 'metadata', None) or {}
+            engine_id = metadata.get('engine_id')
+            records.append((
+                -1 if engine_id is None else engine_id,
+                timings['host'], timings['pid'],
+                _queue_wait(task, metadata, timings['started']),
+                timings['load'], timings['fit'], timings['score'],
+                timings['dump']))
+        return np.rec.fromrecords(records, dtype=TIMINGS_DTYPE)
+
     def elapsed(self):
         all_tasks = self.all_tasks(skip_aborted=False)
         if not all_tasks:
@@ -70,18 +812,116 @@ class TaskManager(object):
         return max([t.elapsed for t in all_tasks])
 
 
+@interactive
+def hostname():
+    import socket
+    return socket.gethostname()
+
+
+class ClusterTopology(object):
+    """Cached mapping between the hosts of a cluster and their engine ids
+
+    The engines are only queried for their hostname when they first register
+    with the controller: the mapping is refreshed lazily when the set of
+    registered engine ids changes.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._engine_ids = frozenset()
+        self._host_of = {}
+        self._engines_on = {}
+        self._warm_hosts = {}
+
+    def refresh(self, force=False):
+        engine_ids = frozenset(self.client.ids)
+        if engine_ids == self._engine_ids and not force:
+            return self
+
+        if force:
+            host_of = {}
+        else:
+            host_of = dict((engine_id, host)
+                           for engine_id, host in self._host_of.items()
+                           if engine_id in engine_ids)
+        new_ids = sorted(engine_ids - frozenset(host_of))
+        if new_ids:
+            host_of.update(self.client[new_ids].apply(hostname).get_dict())
+
+        engines_on = {}
+        for engine_id, host in sorted(host_of.items()):
+            engines_on.setdefault(host, []).append(engine_id)
+
+        self._engine_ids = engine_ids
+        self._host_of = host_of
+        self._engines_on = engines_on
+        return self
+
+    def hosts(self):
+        self.refresh()
+        return sorted(self._engines_on)
+
+    def engines_on(self, host):
+        """Return the ids of the engines running on host"""
+        self.refresh()
+        return list(self._engines_on.get(host, []))
+
+    def host_of(self, engine_id):
+        """Return the hostname of the engine or None if unknown"""
+        self.refresh()
+        return self._host_of.get(engine_id)
+
+    def one_engine_per_host(self):
+        self.refresh()
+        return [engine_ids[0] for _, engine_ids
+                in sorted(self._engines_on.items())]
+
+    def host_view(self):
+        return self.client[self.one_engine_per_host()]
+
+    def mark_warm(self, filenames, engine_ids):
+        """Record that the hosts of engine_ids hold filenames in cache"""
+        hosts = set(self.host_of(engine_id) for engine_id in engine_ids)
+        hosts.discard(None)
+        for filename in filenames:
+            self._warm_hosts.setdefault(filename, set()).update(hosts)
+
+    def forget(self, filenames):
+        """Forget the warm hosts of filenames, e.g. after their removal"""
+        for filename in filenames:
+            self._warm_hosts.pop(filename, None)
+
+    def warm_hosts(self, filename):
+        """Return the hosts known to hold a warm copy of filename"""
+        return sorted(self._warm_hosts.get(filename, ()))
+
+    def warm_engines(self, filename):
+        """Return the ids of the engines running on a warm host of filename"""
+        return [engine_id for host in self.warm_hosts(filename)
+                for engine_id in self.engines_on(host)]
+
+
+_topologies = weakref.WeakKeyDictionary()
+
+
+def get_topology(client):
+    """Return the cached, up to date, ClusterTopology of client"""
+    topology = _topologies.get(client)
+    if topology is None:
+        topology = _topologies[client] = ClusterTopology(client)
+    return topology.refresh()
+
+
+def view_engine_ids(view):
+    """Return the list of engine ids targeted by a direct view"""
+    targets = view.targets
+    if targets is None or targets == 'all':
+        return list(view.client.ids)
+    if isinstance(targets, int):
+        return [targets]
+    return list(targets)
+
+
 def get_host_view(client):
     """Return an IPython parallel direct view with one engine per host."""
-    # First step: query cluster to fetch one engine id per host
-    all_engines = client[:]
-
-    @interactive
-    def hostname():
-        import socket
-        return socket.gethostname()
-
-    hostnames = all_engines.apply(hostname).get_dict()
-    one_engine_per_host = dict((hostname, engine_id)
-                               for engine_id, hostname
-                               in hostnames.items())
-    return client[one_engine_per_host.values()]
+    return get_topology(client).host_view()
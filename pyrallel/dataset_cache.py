@@ -0,0 +1,155 @@
+"""Book keeping of the data files dumped on the hosts of a cluster
+
+Author: Pyrallel contributors
+Licensed: MIT
+"""
+from time import time
+
+
+class DatasetCache(object):
+    """LRU registry of the datasets dumped on the hosts of a backend
+
+    A dataset is a group of files written together on the hosts, e.g. by
+    host_dump or by the persist_cv_splits method of the backend. Their size
+    on each host is recorded when they are added and their last use is
+    updated each time a task is submitted on one of their files.
+
+    When the files of a host exceed max_bytes (unlimited if None), the least
+    recently used datasets are removed from the hosts. Datasets used by
+    tasks that are not completed yet are pinned and never evicted.
+
+        >>> class Backend(object):
+        ...     sizes = {'a.pkl': 60, 'b.pkl': 30, 'c.pkl': 50}
+        ...     def file_sizes(self, filenames):
+        ...         return {'host': dict((f, self.sizes[f])
+        ...                              for f in filenames)}
+        ...     def host_unlink(self, filenames):
+        ...         print('removed %r' % filenames)
+        >>> class Task(object):
+        ...     completed = False
+        ...     def ready(self):
+        ...         return self.completed
+
+        >>> cache = DatasetCache(Backend(), max_bytes=100)
+        >>> cache.add(['a.pkl']), cache.add(['b.pkl'])
+        ([], [])
+        >>> task = Task()
+        >>> cache.use('a.pkl', task)
+        >>> evicted = cache.add(['c.pkl'])
+        removed ['b.pkl']
+        >>> cache.nbytes()
+        {'host': 110}
+        >>> evicted = cache.clear()
+        removed ['c.pkl']
+        >>> task.completed = True
+        >>> evicted = cache.clear()
+        removed ['a.pkl']
+        >>> cache.datasets()
+        []
+
+    """
+
+    def __init__(self, backend, max_bytes=None):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self._files = {}
+        self._file_sizes = {}
+        self._last_used = {}
+        self._users = {}
+        self._dataset_of = {}
+
+    def add(self, filenames):
+        """Register filenames as a dataset and enforce the byte budget
+
+        The new dataset is never evicted by this call, even if it does not
+        fit in the budget by itself. Return the list of evicted filenames.
+        """
+        key = filenames[0]
+        self._forget(key)
+        for filename in filenames:
+            other_key = self._dataset_of.get(filename)
+            if other_key is not None:
+                # Now part of the new dataset
+                self._files[other_key].remove(filename)
+                if not self._files[other_key]:
+                    self._forget(other_key)
+            self._dataset_of[filename] = key
+
+        for host, sizes in self.backend.file_sizes(filenames).items():
+            for filename, size in sizes.items():
+                self._file_sizes.setdefault(filename, {})[host] = size
+        self._files[key] = list(filenames)
+        self._last_used[key] = time()
+        self._users[key] = []
+        return self.evict(keep=[key])
+
+    def use(self, filename, task):
+        """Pin the dataset of filename until task is ready"""
+        key = self._dataset_of.get(filename)
+        if key is None:
+            # Not managed by the cache
+            return
+        self._last_used[key] = time()
+        self._users[key].append(task)
+
+    def pinned(self, key):
+        """True if the dataset of key is used by a task still running"""
+        users = [task for task in self._users.get(key, ())
+                 if not task.ready()]
+        self._users[key] = users
+        return bool(users)
+
+    def nbytes(self):
+        """Return the number of bytes of the registered files per host"""
+        totals = {}
+        for sizes in self._file_sizes.values():
+            for host, size in sizes.items():
+                totals[host] = totals.get(host, 0) + size
+        return totals
+
+    def datasets(self):
+        """Return the keys of the datasets from the least recently used"""
+        return sorted(self._files, key=self._last_used.get)
+
+    def evict(self, max_bytes=None, keep=()):
+        """Remove LRU datasets until the hosts hold at most max_bytes
+
+        max_bytes defaults to the budget of the cache. Pinned datasets and
+        the datasets in keep are never removed. Return the list of evicted
+        filenames.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_bytes is None:
+            return []
+
+        evicted = []
+        for key in self.datasets():
+            totals = self.nbytes()
+            over_budget = set(host for host, total in totals.items()
+                              if total > max_bytes)
+            if not over_budget:
+                break
+            if key in keep or self.pinned(key):
+                continue
+            hosts = set(host for filename in self._files[key]
+                        for host in self._file_sizes.get(filename, ()))
+            if over_budget.isdisjoint(hosts):
+                continue
+            evicted.extend(self._files[key])
+            self._forget(key)
+
+        if evicted:
+            self.backend.host_unlink(evicted)
+        return evicted
+
+    def clear(self):
+        """Remove all the datasets that are not pinned from the hosts"""
+        return self.evict(max_bytes=0)
+
+    def _forget(self, key):
+        for filename in self._files.pop(key, ()):
+            del self._dataset_of[filename]
+            self._file_sizes.pop(filename, None)
+        self._last_used.pop(key, None)
+        self._users.pop(key, None)
@@ -4,7 +4,6 @@ Author: Olivier Grisel <olivier@ogrisel.com>
 Licensed: MIT
 """
 
-import uuid
 import os
 from random import Random
 from copy import copy
@@ -13,8 +12,10 @@ from IPython.parallel import interactive
 
 from sklearn.base import clone
 from sklearn.externals import joblib
+from pyrallel.backends import get_backend
 from pyrallel.common import TaskManager
-from pyrallel.mmap_utils import host_dump
+from pyrallel.mmap_utils import hash_payload
+from pyrallel.mmap_utils import is_shm_filename
 
 
 # Python 2 & 3 compat
@@ -23,6 +24,12 @@ try:
 except NameError:
     basestring = (str, bytes)
 
+try:
+    from pyrallel.aio import AsyncTaskManagerMixin
+except SyntaxError:
+    # No native coroutines under Python 2
+    AsyncTaskManagerMixin = object
+
 
 def combine(all_ensembles):
     """Combine the sub-estimators of a group of ensembles
@@ -96,17 +103,26 @@ def sub_ensemble(ensemble, n_estimators, seed=None):
 @interactive
 def train_model(model, data_filename, model_filename=None,
                 random_state=None):
+    """Fit model on the data, return it (or its filename) and the timings"""
+    from time import time
+    import os
+    import socket
     from sklearn.externals import joblib
+    from pyrallel.mmap_utils import load_data
 
     # Memory map the data
-    X, y, sample_weight = joblib.load(data_filename, mmap_mode='r')
+    started = time()
+    X, y, sample_weight = load_data(data_filename, mmap_mode='r')
+    load_time = time() - started
 
     # Train the model
+    tick = time()
     model.set_params(random_state=random_state)
     if sample_weight is not None:
         model.fit(X, y, sample_weight=sample_weight)
     else:
         model.fit(X, y)
+    fit_time = time() - tick
 
     # Clean the random_state attributes to reduce the amount
     # of useless numpy arrays that will be created on the
@@ -116,19 +132,25 @@ def train_model(model, data_filename, model_filename=None,
                 and hasattr(estimator.tree_, 'random_state')):
             estimator.tree_.random_state = 0
 
+    timings = dict(host=socket.gethostname(), pid=os.getpid(),
+                   started=started, load=load_time, fit=fit_time,
+                   score=0.0, dump=0.0)
+
     # Save the model back to the FS as it can be large
     if model_filename is not None:
+        tick = time()
         joblib.dump(model, model_filename)
-        return model_filename
+        timings['dump'] = time() - tick
+        return model_filename, timings
 
     # TODO: add support for cloud blob stores as an alternative to
     # filesystems.
 
     # Return the tree back to the caller if (useful if the drive)
-    return model
+    return model, timings
 
 
-class EnsembleGrower(TaskManager):
+class EnsembleGrower(TaskManager, AsyncTaskManagerMixin):
     """Distribute computation of sklearn ensembles
 
     This works for averaging ensembles like random forests
@@ -137,13 +159,25 @@ class EnsembleGrower(TaskManager):
     Does not work with sequential ensembles such as AdaBoost or
     GBRT.
 
+    load_balanced_view can be an IPython load balanced view or any
+    pyrallel.backends.Backend instance such as a LocalBackend.
+
+    cache_bytes, if not None, sets the budget in bytes of the data files
+    kept on each host by the dataset cache of the backend. With an
+    unlimited budget, the data files are removed from the hosts on reset.
+
     """
 
-    def __init__(self, load_balanced_view, base_model):
+    def __init__(self, load_balanced_view, base_model, cache_bytes=None):
+        super(EnsembleGrower, self).__init__()
         self.tasks = []
         self.base_model = base_model
         self.lb_view = load_balanced_view
+        self.backend = get_backend(load_balanced_view)
+        if cache_bytes is not None:
+            self.backend.dataset_cache.max_bytes = cache_bytes
         self._temp_files = []
+        self._host_files = []
 
     def reset(self):
         # Abort any other previously scheduled tasks
@@ -151,30 +185,68 @@ class EnsembleGrower(TaskManager):
 
         # Forget about the old tasks
         self.tasks[:] = []
+        self._reset_counters()
 
         # Collect temporary files:
         for filename in self._temp_files:
             os.unlink(filename)
         del self._temp_files[:]
 
+        # Remove the files dumped on the hosts, in shared memory or on disk
+        # once no other task manager uses them
+        if self._host_files:
+            self.backend.release_host_files(self._host_files)
+            del self._host_files[:]
+
     def launch(self, X, y, sample_weight=None, n_estimators=1, pre_warm=True,
-               folder=".", name=None, dump_models=False):
-        self.reset()
+               folder=".", name=None, dump_models=False, digest=None):
+        """Dispatch the data to the hosts and train n_estimators models
+
+        By default the data file is named after the content digest of
+        (X, y, sample_weight) so that launching again on the same data reuses
+        the files already dumped on the hosts. Files whose recorded digest
+        does not match are never trusted and are dumped again.
+
+        The arrays are hashed again at each launch. To skip hashing, pass as
+        digest a token that changes whenever the content of the arrays does,
+        e.g. a version identifier of the dataset: it is trusted as is.
+
+        With a backend using shared memory storage, the data file is held in
+        the RAM of the hosts instead of folder until the next reset. The
+        data files on disk are left to the dataset cache of the backend when
+        it has a byte budget and removed on reset otherwise.
+        """
+        payload = (X, y, sample_weight)
+        if digest is None:
+            digest = hash_payload(payload)
         if name is None:
-            name = uuid.uuid4().get_hex()
+            name = 'data_' + digest
 
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-        data_filename = os.path.join(folder, name + '_data.pkl')
+        data_filename = os.path.join(self.backend.data_folder(folder),
+                                     name + '_data.pkl')
         data_filename = os.path.abspath(data_filename)
 
-        # Dispatch the data files to all the nodes
-        host_dump(self.lb_view.client, (X, y, sample_weight), data_filename,
-                  pre_warm=pre_warm)
+        # Keep the data file of the previous launch if it is reused
+        reused = data_filename in self._host_files
+        if reused:
+            self._host_files.remove(data_filename)
+        self.reset()
 
-        # TODO: handle temporary files on all remote workers
-        #self._temp_files.extend(dumped_filenames)
+        # Dispatch the data files to all the nodes
+        self.backend.host_dump(payload, data_filename, pre_warm=pre_warm,
+                               digest=digest)
+        dataset_cache = self.backend.dataset_cache
+        if (not is_shm_filename(data_filename) and dataset_cache is not None
+                and dataset_cache.max_bytes is not None):
+            # Evicted from the hosts once unused beyond the cache budget
+            dataset_cache.add([data_filename])
+        else:
+            if not reused:
+                self.backend.acquire_host_files([data_filename])
+            self._host_files.append(data_filename)
 
         for i in range(n_estimators):
             base_model = clone(self.base_model)
@@ -184,12 +256,29 @@ class EnsembleGrower(TaskManager):
                 model_filename = os.path.abspath(model_filename)
             else:
                 model_filename = None
-            self.tasks.append(self.lb_view.apply(
-                train_model, base_model, data_filename, model_filename,
-                random_state=i))
+            self.tasks.append(self._submit(
+                train_model, (base_model, data_filename, model_filename),
+                dict(random_state=i), data_filename=data_filename))
         # Make it possible to chain method calls
         return self
 
+    def launch_async(self, *args, **kwargs):
+        """Awaitable variant of launch
+
+        The data dispatch runs in an executor thread so that the event loop
+        is not blocked while the data is shipped to the hosts.
+        """
+        return self._run_in_executor(self.launch, *args, **kwargs)
+
+    def _task_result(self, task, mmap_mode='r'):
+        result, _ = task.get()
+        if isinstance(result, basestring):
+            result = joblib.load(result, mmap_mode=mmap_mode)
+        return result
+
+    def _task_timings(self, task):
+        return task.get()[1]
+
     def report(self, n_top=5):
         output = ("Progress: {0:02d}% ({1:03d}/{2:03d}),"
                   " elapsed: {3:0.3f}s\n").format(
@@ -203,10 +292,7 @@ class EnsembleGrower(TaskManager):
     def aggregate_model(self, mmap_mode='r'):
         ready_models = []
         for task in self.completed_tasks():
-            result = task.get()
-            if isinstance(result, basestring):
-                result = joblib.load(result, mmap_mode=mmap_mode)
-            ready_models.append(result)
+            ready_models.append(self._task_result(task, mmap_mode=mmap_mode))
 
         if not ready_models:
             return None
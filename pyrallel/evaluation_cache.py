@@ -0,0 +1,273 @@
+"""Persistent store of the evaluations of the model selection tasks
+
+Author: Pyrallel contributors
+Licensed: MIT
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+
+import numpy as np
+
+
+# Python 2 & 3 compat
+try:
+    basestring
+except NameError:
+    basestring = (str, bytes)
+
+
+# Digests of the split files already hashed by this process, keyed by
+# (filename, size, modification time)
+_split_digests = {}
+
+
+def _hash_files(h, filenames, block_size=2 ** 20):
+    for filename in filenames:
+        h.update(os.path.basename(filename).encode('utf-8'))
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                h.update(block)
+
+
+def split_digest(cv_split_filename):
+    """Hex digest of the content of a CV split file
+
+    The data file referenced by an index based split file is part of the
+    content: its recorded digest is used if any, else its files are hashed.
+    Return None if the split file is not visible from the client, e.g. when
+    it was only written on the engine hosts.
+    """
+    from pyrallel.mmap_utils import backing_filenames
+    from pyrallel.mmap_utils import cv_split_data_filenames
+    from pyrallel.mmap_utils import digest_filename
+
+    if not os.path.exists(cv_split_filename):
+        return None
+    stat = os.stat(cv_split_filename)
+    memo_key = (os.path.abspath(cv_split_filename), stat.st_size,
+                stat.st_mtime)
+    digest = _split_digests.get(memo_key)
+    if digest is not None:
+        return digest
+
+    h = hashlib.md5()
+    _hash_files(h, backing_filenames(cv_split_filename))
+    for data_filename in cv_split_data_filenames([cv_split_filename]):
+        if os.path.exists(digest_filename(data_filename)):
+            with open(digest_filename(data_filename)) as f:
+                h.update(f.read().strip().encode('utf-8'))
+        elif os.path.exists(data_filename):
+            _hash_files(h, backing_filenames(data_filename))
+        else:
+            return None
+    digest = _split_digests[memo_key] = h.hexdigest()
+    return digest
+
+
+def _update_canonical(h, value):
+    """Hash value by content, independently of its memory address"""
+    if isinstance(value, dict):
+        items = sorted((hash_value(k), k, v) for k, v in value.items())
+        h.update(('dict:%d:' % len(items)).encode('ascii'))
+        for digest, _, item in items:
+            h.update(digest.encode('ascii'))
+            _update_canonical(h, item)
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s:%d:' % (type(value).__name__, len(value)))
+                 .encode('ascii'))
+        for item in value:
+            _update_canonical(h, item)
+    elif isinstance(value, np.ndarray):
+        h.update(repr(('ndarray', value.dtype.str, value.shape))
+                 .encode('utf-8'))
+        if value.dtype.hasobject:
+            _update_canonical(h, value.tolist())
+        else:
+            h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.generic):
+        _update_canonical(h, value.item())
+    elif value is None or isinstance(value, (bool, int, float, complex,
+                                             basestring)):
+        h.update(repr((type(value).__name__, value)).encode('utf-8'))
+    elif isinstance(value, np.random.RandomState):
+        h.update(b'RandomState:')
+        _update_canonical(h, value.get_state())
+    elif hasattr(value, 'get_params'):
+        # Estimators are described by their class and their parameters
+        value_class = type(value)
+        h.update(('estimator:%s.%s:' % (value_class.__module__,
+                                        value_class.__name__))
+                 .encode('utf-8'))
+        _update_canonical(h, value.get_params(deep=True))
+    elif callable(value) and hasattr(value, '__qualname__'):
+        h.update(('callable:%s.%s' % (value.__module__, value.__qualname__))
+                 .encode('utf-8'))
+    else:
+        try:
+            h.update(pickle.dumps(value, 2))
+        except Exception:
+            raise TypeError("Cannot hash %r by content" % (value,))
+
+
+def hash_value(value):
+    """Hex digest of the content of value
+
+    Dicts are hashed by sorted items, arrays by their dtype, shape and data
+    and estimators by their class and get_params(deep=True), so that the
+    digest does not depend on memory addresses nor on the truncation of the
+    repr of large arrays. Raise TypeError if value cannot be hashed.
+
+        >>> import numpy as np
+        >>> hash_value({'C': 1.0, 'gamma': np.float64(0.1)}) == hash_value(
+        ...     {'gamma': 0.1, 'C': 1.0})
+        True
+        >>> hash_value(1) == hash_value(1.0)
+        False
+        >>> a = np.arange(10000)
+        >>> hash_value(a) == hash_value(a.copy())
+        True
+        >>> a[5000] = -1
+        >>> hash_value(a) == hash_value(np.arange(10000))
+        False
+
+    """
+    h = hashlib.sha1()
+    _update_canonical(h, value)
+    return h.hexdigest()
+
+
+def evaluation_key(model, params, cv_split_filename, train_size=1.0):
+    """Key of the evaluation of model with params on a CV split file
+
+    The key hashes the class of the model, its parameters that are not
+    searched, the candidate params, the training set size and the content
+    of the split file. Return None if the split file or the parameters
+    cannot be hashed.
+    """
+    digest = split_digest(cv_split_filename)
+    if digest is None:
+        return None
+    model_class = type(model)
+    fixed_params = {}
+    if hasattr(model, 'get_params'):
+        fixed_params = dict((name, value)
+                            for name, value in model.get_params(deep=True)
+                            .items() if name not in params)
+    try:
+        return hash_value((
+            '%s.%s' % (model_class.__module__, model_class.__name__),
+            fixed_params, params, train_size, digest))
+    except TypeError:
+        return None
+
+
+class CachedResult(object):
+    """AsyncResult-like holder of an evaluation found in the cache
+
+    The result is ready from the start and never sent to the backend.
+    """
+
+    attempts = ()
+    msg_ids = ()
+    metadata = None
+    elapsed = 0.0
+    _exception = None
+
+    def __init__(self, result):
+        self._result = result
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+    def wait(self, timeout=-1):
+        pass
+
+    def get(self, timeout=-1):
+        return self._result
+
+    def abort(self):
+        assert not self.ready(), "Can't abort, result is already ready"
+
+
+class EvaluationCache(object):
+    """SQLite store of the evaluation tuples keyed by evaluation_key
+
+    The store is a local file that survives the restarts of the client so
+    that the evaluations already computed are not submitted again.
+
+        >>> import os
+        >>> import shutil
+        >>> import tempfile
+        >>> folder = tempfile.mkdtemp()
+        >>> filename = os.path.join(folder, 'evaluations.sqlite')
+        >>> cache = EvaluationCache(filename)
+        >>> cache.put('key', [0.9, 0.95, 1.5, 1.0, {'C': 1.0}, {}])
+        >>> cache.close()
+
+        >>> cache = EvaluationCache(filename)
+        >>> cache.get('key')
+        (0.9, 0.95, 1.5, 1.0, {'C': 1.0}, {})
+        >>> cache.get('other') is None
+        True
+        >>> len(cache)
+        1
+        >>> cache.clear()
+        >>> len(cache)
+        0
+        >>> cache.close()
+        >>> shutil.rmtree(folder)
+
+    """
+
+    def __init__(self, filename='pyrallel_evaluations.sqlite'):
+        self.filename = filename
+        self._lock = threading.Lock()
+        # Results are stored from the completion callbacks of the tasks
+        self._connection = sqlite3.connect(filename, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS evaluations"
+                " (key TEXT PRIMARY KEY, evaluation BLOB)")
+
+    def get(self, key):
+        """Return the evaluation tuple stored under key or None"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT evaluation FROM evaluations WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def put(self, key, evaluation):
+        """Store the evaluation tuple under key"""
+        blob = sqlite3.Binary(pickle.dumps(tuple(evaluation), 2))
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO evaluations VALUES (?, ?)",
+                (key, blob))
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    def clear(self):
+        """Remove all the stored evaluations"""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM evaluations")
+
+    def close(self):
+        self._connection.close()
@@ -7,13 +7,37 @@ import os
 from IPython.parallel import interactive
 
 from pyrallel.common import get_host_view
+from pyrallel.common import get_topology
+from pyrallel.common import view_engine_ids
+
+
+# tmpfs mount point of the POSIX shared memory on Linux hosts: the files
+# created there live in RAM and their memory maps are shared by all the
+# processes of the host without any copy nor disk access.
+SHM_FOLDER = '/dev/shm'
+
+
+def shm_folder(name='pyrallel'):
+    """Folder for data files stored in the shared memory of the hosts"""
+    return os.path.join(SHM_FOLDER, name)
+
+
+def is_shm_filename(filename):
+    """True if filename is stored in the shared memory of its host"""
+    return os.path.abspath(filename).startswith(SHM_FOLDER + os.sep)
 
 
 @interactive
 def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
                       train_size=None, test_size=0.25, random_state=None,
-                      folder='.'):
-    """Materialize randomized train test splits of a dataset."""
+                      folder='.', materialize=False):
+    """Persist randomized train test splits of a dataset.
+
+    By default X and y are stored once in a ``name + '_data.pkl'`` file and
+    each split file only holds the train and test indices: the folds are
+    gathered from the memory mapped arrays by load_cv_split. Use
+    materialize=True to store a full copy of the arrays of each fold.
+    """
     from sklearn.externals import joblib
     from sklearn.cross_validation import ShuffleSplit
     import os
@@ -22,12 +46,30 @@ def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
     if name is None:
         name = uuid.uuid4().get_hex()
 
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+    if hasattr(X, 'tocsr'):
+        # Sparse matrices are sliced by rows
+        X = X.tocsr()
+
     cv = ShuffleSplit(X.shape[0], n_iter=n_cv_iter,
                       test_size=test_size, random_state=random_state)
     cv_split_filenames = []
 
+    if not materialize:
+        data_filename = os.path.abspath(
+            os.path.join(folder, name + '_data.pkl'))
+        joblib.dump((X, y), data_filename)
+
     for i, (train, test) in enumerate(cv):
-        cv_fold = (X[train], y[train], X[test], y[test])
+        if materialize:
+            cv_fold = (X[train], y[train], X[test], y[test])
+        else:
+            cv_fold = dict(data=data_filename, train=train, test=test)
         cv_split_filename = os.path.join(folder, name + suffix % i)
         cv_split_filename = os.path.abspath(cv_split_filename)
         joblib.dump(cv_fold, cv_split_filename)
@@ -38,55 +80,796 @@ def persist_cv_splits(X, y, name=None, n_cv_iter=5, suffix="_cv_%03d.pkl",
     return cv_split_filenames
 
 
+def cv_split_data_filenames(cv_split_filenames):
+    """Return the data files referenced by index based CV split files"""
+    from sklearn.externals import joblib
+    data_filenames = []
+    for cv_split_filename in cv_split_filenames:
+        if not os.path.exists(cv_split_filename):
+            # Split file only available on the engine hosts
+            continue
+        cv_split = joblib.load(cv_split_filename, mmap_mode='r')
+        if (isinstance(cv_split, dict)
+                and cv_split['data'] not in data_filenames):
+            data_filenames.append(cv_split['data'])
+    return data_filenames
+
+
+def take_rows(X, indices, chunk_size=4096):
+    """Gather X[indices] reading the rows of X in increasing order
+
+    The rows are copied chunk_size at a time so that the reads on a memory
+    mapped X are sequential and no large temporary array is allocated.
+    Sparse matrices are sliced by rows in CSR format without densifying.
+
+        >>> import numpy as np
+        >>> import scipy.sparse as sp
+        >>> X = np.arange(12).reshape(6, 2)
+        >>> indices = np.array([4, 0, 5, 2])
+        >>> take_rows(X, indices, chunk_size=3)
+        array([[ 8,  9],
+               [ 0,  1],
+               [10, 11],
+               [ 4,  5]])
+        >>> rows = take_rows(sp.csr_matrix(X), indices)
+        >>> rows.format
+        'csr'
+        >>> rows.toarray()
+        array([[ 8,  9],
+               [ 0,  1],
+               [10, 11],
+               [ 4,  5]])
+
+    """
+    import numpy as np
+    import scipy.sparse as sp
+    order = np.argsort(indices, kind='mergesort')
+    sorted_indices = indices[order]
+    if sp.issparse(X):
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return X.tocsr()[sorted_indices][inverse]
+    out = np.empty((len(indices),) + X.shape[1:], dtype=X.dtype)
+    for start in range(0, len(indices), chunk_size):
+        stop = start + chunk_size
+        out[order[start:stop]] = X[sorted_indices[start:stop]]
+    return out
+
+
+def load_data(filename, mmap_mode='r'):
+    """Load a payload dumped with joblib or streamed by host_dump
+
+    This function is meant to be imported and called on the engines.
+    Streamed payloads are stored as a manifest file referencing one ``.npy``
+    file per array, or one per data, indices and indptr array of the CSR
+    matrices: the arrays are memory mapped and returned in a tuple along
+    with the other items of the payload.
+    """
+    from sklearn.externals import joblib
+    import numpy as np
+    import scipy.sparse as sp
+    payload = joblib.load(filename, mmap_mode=mmap_mode)
+    if not (isinstance(payload, dict) and 'pyrallel_arrays' in payload):
+        return payload
+
+    folder = os.path.dirname(filename)
+    items = []
+    for kind, value in payload['pyrallel_arrays']:
+        if kind == 'npy':
+            value = np.load(os.path.join(folder, value), mmap_mode=mmap_mode)
+        elif kind == 'csr':
+            shape, basenames = value
+            components = [np.load(os.path.join(folder, basename),
+                                  mmap_mode=mmap_mode)
+                          for basename in basenames]
+            value = sp.csr_matrix(tuple(components), shape=shape, copy=False)
+        items.append(value)
+    return tuple(items)
+
+
+def load_cv_split(cv_split_filename, mmap_mode='r', train_size=1.0):
+    """Load the (X_train, y_train, X_test, y_test) fold of a CV split file
+
+    This function is meant to be imported and called on the engines.
+    Materialized folds are memory mapped as they are while the folds of index
+    based split files are gathered from the memory mapped base arrays.
+
+    Only the first samples of the training set are loaded: train_size is
+    either a fraction of the training set (if <= 1.0) or a number of samples.
+    The training rows of index based folds are selected before gathering.
+
+        >>> import os
+        >>> import shutil
+        >>> import tempfile
+        >>> import numpy as np
+        >>> from sklearn.externals import joblib
+        >>> folder = tempfile.mkdtemp()
+        >>> X, y = np.arange(20).reshape(10, 2), np.arange(10)
+        >>> data_filename = os.path.join(folder, 'data.pkl')
+        >>> _ = joblib.dump((X, y), data_filename)
+        >>> cv_split_filename = os.path.join(folder, 'cv_000.pkl')
+        >>> _ = joblib.dump(dict(data=data_filename,
+        ...                      train=np.array([6, 2, 8, 4]),
+        ...                      test=np.array([1, 3])), cv_split_filename)
+
+        >>> X_train, y_train, X_test, y_test = load_cv_split(
+        ...     cv_split_filename, train_size=0.5)
+        >>> X_train
+        array([[12, 13],
+               [ 4,  5]])
+        >>> y_train, y_test
+        (array([6, 2]), array([1, 3]))
+        >>> load_cv_split(cv_split_filename, train_size=3)[1]
+        array([6, 2, 8])
+
+        >>> shutil.rmtree(folder)
+
+    """
+    from sklearn.externals import joblib
+
+    def n_samples_train(n_samples):
+        if train_size <= 1.0:
+            return int(train_size * n_samples)
+        return int(train_size)
+
+    cv_split = joblib.load(cv_split_filename, mmap_mode=mmap_mode)
+    if not isinstance(cv_split, dict):
+        X_train, y_train, X_test, y_test = cv_split
+        n_train = n_samples_train(X_train.shape[0])
+        return X_train[:n_train], y_train[:n_train], X_test, y_test
+
+    X, y = load_data(cv_split['data'], mmap_mode=mmap_mode)
+    train, test = cv_split['train'], cv_split['test']
+    train = train[:n_samples_train(len(train))]
+    return take_rows(X, train), y[train], take_rows(X, test), y[test]
+
+
+def backing_filenames(filename):
+    """Return filename and the .npy files holding the arrays of its payload
+
+    This covers the companion files written by joblib.dump and the array
+    files of the payloads streamed by host_dump.
+    """
+    import glob
+    return [filename] + sorted(glob.glob(filename + '_*.npy'))
+
+
+def resident_pages(filename):
+    """Return a boolean array flagging the pages of filename in the page cache
+
+    The residency is queried with mincore on a memory map of the file.
+    Return None if mincore is not available on this platform.
+    """
+    import ctypes
+    import ctypes.util
+    import mmap
+    import numpy as np
+    size = os.path.getsize(filename)
+    n_pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    if n_pages == 0:
+        return np.zeros(0, dtype=np.bool_)
+    try:
+        mincore = ctypes.CDLL(ctypes.util.find_library('c')).mincore
+    except (OSError, AttributeError):
+        return None
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p]
+    mincore.restype = ctypes.c_int
+    mapped = np.memmap(filename, dtype=np.uint8, mode='r')
+    vec = np.zeros(n_pages, dtype=np.uint8)
+    try:
+        if mincore(mapped.ctypes.data, size, vec.ctypes.data) != 0:
+            return None
+    finally:
+        del mapped
+    return (vec & 1).astype(np.bool_)
+
+
+def cold_ranges(filename, chunk_size=16 * 2 ** 20):
+    """Return the (offset, length) ranges of filename not in the page cache
+
+    Ranges are at most chunk_size bytes long so that they can be read in
+    parallel. The whole file is considered cold when the residency of its
+    pages cannot be queried.
+    """
+    import mmap
+    import numpy as np
+    size = os.path.getsize(filename)
+    resident = resident_pages(filename)
+    if resident is None:
+        runs = [(0, size)] if size else []
+    else:
+        cold = np.flatnonzero(~resident)
+        breaks = np.flatnonzero(np.diff(cold) != 1) + 1
+        runs = [(run[0] * mmap.PAGESIZE,
+                 min((run[-1] + 1) * mmap.PAGESIZE, size))
+                for run in np.split(cold, breaks) if len(run)]
+        runs = [(start, stop - start) for start, stop in runs]
+    ranges = []
+    for start, length in runs:
+        for offset in range(start, start + length, chunk_size):
+            ranges.append(
+                (offset, min(chunk_size, start + length - offset)))
+    return ranges
+
+
+def read_range(filename, offset, length, buffer_size=2 ** 20):
+    """Read a range of filename to load it in the page cache
+
+    The kernel is first advised to read ahead the whole range. Return the
+    number of bytes read.
+    """
+    fadvise = getattr(os, 'posix_fadvise', None)
+    buf = bytearray(min(buffer_size, length))
+    view = memoryview(buf)
+    n_read = 0
+    with open(filename, 'rb') as f:
+        if fadvise is not None:
+            fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+        f.seek(offset)
+        while n_read < length:
+            n = f.readinto(view[:min(len(buf), length - n_read)])
+            if not n:
+                break
+            n_read += n
+    return n_read
+
+
+@interactive
+def load_in_memory(filenames, n_threads=4, chunk_size=16 * 2 ** 20):
+    """Load the files backing the arrays of filenames in the page cache
+
+    The base data of index based CV split files is warmed as well. Pages
+    that are already resident (checked with mincore) are skipped and the
+    cold ranges are read by n_threads threads in chunks of chunk_size
+    bytes. Return the hostname, the total and warmed number of bytes, the
+    duration and the throughput of the warm-up.
+    """
+    from multiprocessing.pool import ThreadPool
+    import os
+    import socket
+    from time import time
+    from pyrallel.mmap_utils import backing_filenames
+    from pyrallel.mmap_utils import cold_ranges
+    from pyrallel.mmap_utils import load_data
+    from pyrallel.mmap_utils import read_range
+
+    started = time()
+    to_warm = []
+    for filename in filenames:
+        to_warm.extend(backing_filenames(filename))
+        arrays = load_data(filename, mmap_mode='r')
+        if isinstance(arrays, dict):
+            # Index based CV split: warm the shared base arrays as well
+            to_warm.extend(backing_filenames(arrays['data']))
+    to_warm = sorted(set(to_warm), key=to_warm.index)
+
+    bytes_total = sum(os.path.getsize(f) for f in to_warm)
+    work = [(filename, offset, length) for filename in to_warm
+            for offset, length in cold_ranges(filename, chunk_size)]
+    if work:
+        pool = ThreadPool(min(n_threads, len(work)))
+        try:
+            bytes_warmed = sum(pool.map(lambda args: read_range(*args), work))
+        finally:
+            pool.close()
+    else:
+        bytes_warmed = 0
+
+    duration = time() - started
+    throughput = bytes_warmed / duration if duration > 0 else 0.0
+    return dict(host=socket.gethostname(), bytes_total=bytes_total,
+                bytes_warmed=bytes_warmed, seconds=duration,
+                throughput=throughput)
+
+
+@interactive
+def dump_payload(payload, filename, digest=None, lock_timeout=3600):
+    """Atomically dump payload to filename, creating the parent folder
+
+    The payload is dumped in a temporary folder and the resulting files are
+    renamed into place, the main file last, so that readers never see a
+    partially written file. Concurrent writers of the same path, e.g. on
+    several hosts sharing a filesystem, are serialized by an exclusive lock
+    file: the other writers wait for the first one to complete and do not
+    write the payload again. Locks older than lock_timeout seconds are
+    considered stale.
+
+    If digest is not None, it is recorded as the content digest of filename.
+    """
+    from sklearn.externals import joblib
+    import os
+    import shutil
+    import time
+    import uuid
+    from pyrallel.mmap_utils import digest_filename
+
+    def is_complete():
+        if not os.path.exists(filename):
+            return False
+        if digest is None:
+            return True
+        try:
+            with open(digest_filename(filename)) as f:
+                return f.read().strip() == digest
+        except IOError:
+            return False
+
+    folder = os.path.dirname(filename)
+    try:
+        os.makedirs(folder)
+    except OSError:
+        if not os.path.isdir(folder):
+            raise
+
+    lock_filename = filename + '.lock'
+    while True:
+        try:
+            os.close(os.open(lock_filename,
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError:
+            pass
+        try:
+            lock_age = time.time() - os.path.getmtime(lock_filename)
+        except OSError:
+            # Released in the meantime
+            lock_age = None
+        if lock_age is None or lock_age > lock_timeout:
+            if lock_age is not None:
+                try:
+                    os.unlink(lock_filename)
+                except OSError:
+                    pass
+            if is_complete():
+                return [filename]
+            continue
+        time.sleep(0.1)
+
+    tmp_folder = os.path.join(folder, '.tmp-' + uuid.uuid4().hex)
+    try:
+        if is_complete():
+            # Written by a concurrent writer that released the lock
+            return [filename]
+        os.makedirs(tmp_folder)
+        tmp_filenames = joblib.dump(
+            payload, os.path.join(tmp_folder, os.path.basename(filename)))
+        # joblib returns the main file first: move it after its companion
+        # files and before the digest that certifies it
+        tmp_filenames = tmp_filenames[1:] + tmp_filenames[:1]
+        if digest is not None:
+            tmp_digest_filename = digest_filename(tmp_filenames[-1])
+            with open(tmp_digest_filename, 'w') as f:
+                f.write(digest)
+            tmp_filenames.append(tmp_digest_filename)
+
+        filenames = []
+        for tmp_filename in tmp_filenames:
+            final_filename = os.path.join(folder,
+                                          os.path.basename(tmp_filename))
+            os.rename(tmp_filename, final_filename)
+            filenames.append(final_filename)
+        return filenames
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.unlink(lock_filename)
+
+
 def warm_mmap(client, data_filenames, host_view=None):
-    """Trigger a disk load on all the arrays data_filenames.
+    """Load the arrays of data_filenames in the page cache of each host.
 
     Assume the files are shared on all the hosts using NFS or
     have been previously been dumped there with the host_dump function.
+
+    Only the ranges of the files that are not already in the page cache
+    are read. Return a dict mapping each host to its warm-up statistics
+    (see load_in_memory).
     """
     if host_view is None:
         host_view = get_host_view(client)
 
-    # Second step: for each data file and host, mmap the arrays of the file
-    # and trigger a sequential read of all the arrays' data
-    @interactive
-    def load_in_memory(filenames):
-        from sklearn.externals import joblib
-        for filename in filenames:
-            arrays = joblib.load(filename, mmap_mode='r')
-            for array in arrays:
-                if hasattr(array, 'max'):
-                    array.max()  # trigger the disk read
-
+    # Files in shared memory are already in RAM: there is nothing to read.
     data_filenames = [os.path.abspath(f) for f in data_filenames]
-    host_view.apply_sync(load_in_memory, data_filenames)
+    disk_filenames = [f for f in data_filenames if not is_shm_filename(f)]
+    stats = {}
+    if disk_filenames:
+        for host_stats in host_view.apply_sync(load_in_memory,
+                                               disk_filenames):
+            stats[host_stats['host']] = host_stats
+
+    # Remember where the data is hot for locality aware scheduling
+    get_topology(host_view.client).mark_warm(
+        data_filenames, view_engine_ids(host_view))
+    return stats
 
 
 # Backward compat
 warm_mmap_on_cv_splits = warm_mmap
 
 
-def _missing_file_engine_ids(view, filename):
-    """Return the list of engine ids where filename does not exist"""
+@interactive
+def file_sizes(filenames):
+    """Return the hostname and the size of the existing filenames
+
+    The size of a file includes its companion and digest files.
+    """
+    import glob
+    import os
+    import socket
+    sizes = {}
+    for filename in filenames:
+        if not os.path.exists(filename):
+            continue
+        paths = [filename] + glob.glob(filename + '_*')
+        sizes[filename] = sum(os.path.getsize(path) for path in paths
+                              if os.path.exists(path))
+    return socket.gethostname(), sizes
+
+
+@interactive
+def unlink_files(filenames):
+    """Remove filenames with their companion, digest and lock files"""
+    import glob
+    import os
+    for filename in filenames:
+        paths = [filename, filename + '.lock'] + glob.glob(filename + '_*')
+        for path in paths:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+def host_unlink(client, filenames, host_view=None):
+    """Remove filenames and their companion files on each host"""
+    if host_view is None:
+        host_view = get_host_view(client)
+    filenames = [os.path.abspath(f) for f in filenames]
+    host_view.apply_sync(unlink_files, filenames)
+    get_topology(host_view.client).forget(filenames)
+
+
+def host_file_sizes(client, filenames, host_view=None):
+    """Return a dict mapping each host to the sizes of filenames there"""
+    if host_view is None:
+        host_view = get_host_view(client)
+    filenames = [os.path.abspath(f) for f in filenames]
+    return dict(host_view.apply_sync(file_sizes, filenames))
+
+
+def hash_payload(payload, block_size=64 * 2 ** 20):
+    """Hex digest of the content of a payload of arrays and other objects
+
+    The dtype, shape and data of the arrays are hashed block by block to
+    avoid large temporary copies, the other items are hashed as pickles.
+    Sparse matrices are hashed as the data, indices and indptr arrays of
+    their CSR representation.
+    """
+    import hashlib
+    import pickle
+    import numpy as np
+    import scipy.sparse as sp
+
+    def update(array):
+        h.update(repr((array.dtype.str, array.shape)).encode('utf-8'))
+        if array.ndim == 0:
+            h.update(array.tobytes())
+            return
+        n_rows = max(block_size // max(array[:1].nbytes, 1), 1)
+        for start in range(0, array.shape[0], n_rows):
+            block = np.ascontiguousarray(array[start:start + n_rows])
+            h.update(block.tobytes())
+
+    h = hashlib.md5()
+    for item in payload:
+        if isinstance(item, np.ndarray):
+            update(item)
+        elif sp.issparse(item):
+            item = item.tocsr()
+            h.update(repr(('csr', item.shape)).encode('utf-8'))
+            for array in (item.data, item.indices, item.indptr):
+                update(array)
+        else:
+            h.update(pickle.dumps(item, 2))
+    return h.hexdigest()
+
+
+def digest_filename(filename):
+    """Name of the file recording the content digest of filename"""
+    return filename + '_digest.txt'
+
+
+def _missing_file_engine_ids(view, filenames, digest=None):
+    """Return the list of engine ids where one of filenames does not exist
+
+    If digest is not None, filenames whose recorded content digest does not
+    match are considered missing as well.
+    """
 
     @interactive
-    def missing(filename):
+    def missing(filenames, digest):
         import os
-        return not os.path.exists(filename)
+        from pyrallel.mmap_utils import digest_filename
+        for filename in filenames:
+            if not os.path.exists(filename):
+                return True
+            if digest is None:
+                continue
+            try:
+                with open(digest_filename(filename)) as f:
+                    if f.read().strip() != digest:
+                        return True
+            except IOError:
+                return True
+        return False
 
     missing_ids = []
-    for id_, is_missing in view.apply(missing, filename).get_dict().items():
+    results = view.apply(missing, filenames, digest).get_dict()
+    for id_, is_missing in results.items():
         if is_missing:
             missing_ids.append(id_)
     return missing_ids
 
 
-def host_dump(client, payload, target_filename, host_view=None, pre_warm=True):
+@interactive
+def serve_files(filename, n_clients=1, timeout=600, interface='',
+                address=None):
+    """Serve filename and its companion files over TCP
+
+    The files are served from a background thread to n_clients successive
+    connections that present the random token of the transfer: other
+    connections are dropped. The server listens on interface, all the
+    interfaces by default, and is advertised to the other hosts under
+    address, by default the fully qualified hostname of the engine that
+    they resolve themselves: the hostname can resolve to a loopback address
+    on its own host.
+
+    Return the ((address, port), token) pair to pass to fetch_files.
+    """
+    import binascii
+    import glob
+    import hmac
+    import os
+    import socket
+    import struct
+    import threading
+    from time import time
+
+    filenames = [filename] + sorted(glob.glob(filename + '_*'))
+    if address is None:
+        address = socket.getfqdn()
+    token = binascii.hexlify(os.urandom(16))
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind((interface, 0))
+    server.listen(n_clients)
+    deadline = time() + timeout
+
+    def authenticated(conn):
+        conn.settimeout(10)
+        received = b''
+        try:
+            while len(received) < len(token):
+                chunk = conn.recv(len(token) - len(received))
+                if not chunk:
+                    return False
+                received += chunk
+        except socket.error:
+            return False
+        conn.settimeout(None)
+        return hmac.compare_digest(received, token)
+
+    def serve():
+        try:
+            n_served = 0
+            while n_served < n_clients:
+                server.settimeout(max(deadline - time(), 0.001))
+                conn, _ = server.accept()
+                try:
+                    if not authenticated(conn):
+                        continue
+                    n_served += 1
+                    for path in filenames:
+                        name = os.path.basename(path).encode('utf-8')
+                        size = os.path.getsize(path)
+                        conn.sendall(struct.pack('!IQ', len(name), size))
+                        conn.sendall(name)
+                        with open(path, 'rb') as f:
+                            while True:
+                                block = f.read(1 << 20)
+                                if not block:
+                                    break
+                                conn.sendall(block)
+                    conn.sendall(struct.pack('!IQ', 0, 0))
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return (address, server.getsockname()[1]), token.decode('ascii')
+
+
+@interactive
+def fetch_files(address, token, folder):
+    """Fetch into folder the files served at address by serve_files"""
+    import os
+    import socket
+    import struct
+    import uuid
+
+    def read_exactly(conn, size):
+        chunks = []
+        while size:
+            chunk = conn.recv(min(size, 1 << 20))
+            if not chunk:
+                raise IOError("Connection closed by %s:%d" % address)
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    address = tuple(address)
+    conn = socket.create_connection(address)
+    fetched = []
+    try:
+        conn.sendall(token.encode('ascii'))
+        while True:
+            name_size, size = struct.unpack('!IQ', read_exactly(conn, 12))
+            if name_size == 0:
+                break
+            name = read_exactly(conn, name_size).decode('utf-8')
+            path = os.path.join(folder, name)
+            tmp_path = path + '.tmp-' + uuid.uuid4().hex
+            with open(tmp_path, 'wb') as f:
+                while size:
+                    block = read_exactly(conn, min(size, 1 << 20))
+                    f.write(block)
+                    size -= len(block)
+            os.rename(tmp_path, path)
+            fetched.append(path)
+    finally:
+        conn.close()
+    return fetched
+
+
+@interactive
+def open_array_file(filename, dtype, shape):
+    """Preallocate a .npy file to be filled by write_array_block"""
+    import os
+    import numpy as np
+    folder = os.path.dirname(filename)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                      shape=shape)
+    del array
+    return filename
+
+
+@interactive
+def write_array_block(filename, start, block):
+    """Write block in the rows of the .npy file starting at start"""
+    import numpy as np
+    array = np.load(filename, mmap_mode='r+')
+    array[start:start + block.shape[0]] = block
+    array.flush()
+    return start
+
+
+def _stream_array(view, array, array_filename, block_size,
+                  max_blocks_in_flight):
+    """Write array into a preallocated .npy file on the engines of view"""
+    import numpy as np
+    view.apply_sync(open_array_file, array_filename, array.dtype,
+                    array.shape)
+    row_size = max(array[:1].nbytes, 1)
+    n_rows = max(block_size // row_size, 1)
+    in_flight = []
+    for start in range(0, array.shape[0], n_rows):
+        block = np.ascontiguousarray(array[start:start + n_rows])
+        in_flight.append(view.apply(
+            write_array_block, array_filename, start, block))
+        if len(in_flight) >= max_blocks_in_flight:
+            in_flight.pop(0).get()
+    for task in in_flight:
+        task.get()
+
+
+def _stream_payload(client, engine_ids, payload, target_filename,
+                    block_size=64 * 2 ** 20, max_blocks_in_flight=2,
+                    digest=None):
+    """Stream the arrays of payload to the engines block by block
+
+    Each array is written into a preallocated memory mapped ``.npy`` file on
+    the engines' hosts so that neither the client nor the engines hold more
+    than a few blocks in memory. Sparse matrices are streamed as the data,
+    indices and indptr arrays of their CSR representation. A manifest
+    referencing the arrays is written at target_filename last: it can then
+    be read with load_data. If digest is not None, it is recorded with the
+    manifest and replaces a stale manifest with a different digest.
+    """
+    import numpy as np
+    import scipy.sparse as sp
+    view = client[engine_ids]
+    manifest = []
+    for i, item in enumerate(payload):
+        if sp.issparse(item):
+            item = item.tocsr()
+            basenames = []
+            for component in ('data', 'indices', 'indptr'):
+                array_filename = target_filename + '_%02d_%s.npy' % (
+                    i, component)
+                _stream_array(view, getattr(item, component), array_filename,
+                              block_size, max_blocks_in_flight)
+                basenames.append(os.path.basename(array_filename))
+            manifest.append(('csr', (item.shape, basenames)))
+            continue
+
+        if not isinstance(item, np.ndarray) or item.ndim == 0:
+            manifest.append(('object', item))
+            continue
+
+        array_filename = target_filename + '_%02d.npy' % i
+        _stream_array(view, item, array_filename, block_size,
+                      max_blocks_in_flight)
+        manifest.append(('npy', os.path.basename(array_filename)))
+
+    view.apply_sync(dump_payload, dict(pyrallel_arrays=manifest),
+                    target_filename, digest=digest)
+
+
+def _tree_broadcast(client, filename, source_ids, target_ids):
+    """Copy filename from source_ids engines to target_ids engines
+
+    At each round every engine holding the file forwards it to one engine
+    missing it so that the number of holders doubles: the number of rounds
+    grows with the logarithm of the number of targets and the client does
+    not send any data. The engines must be able to resolve the hostnames
+    of one another and to open TCP connections to them.
+    """
+    holders, targets = list(source_ids), list(target_ids)
+    folder = os.path.dirname(filename)
+    while targets:
+        senders = holders[:len(targets)]
+        receivers, targets = targets[:len(senders)], targets[len(senders):]
+        servers = [client[sender].apply(serve_files, filename)
+                   for sender in senders]
+        fetches = []
+        for receiver, server in zip(receivers, servers):
+            address, token = server.get()
+            fetches.append(client[receiver].apply(
+                fetch_files, address, token, folder))
+        for fetch in fetches:
+            fetch.get()
+        holders.extend(receivers)
+
+
+def host_dump(client, payload, target_filename, host_view=None, pre_warm=True,
+              broadcast='client', stream=False, block_size=64 * 2 ** 20,
+              digest=None):
     """Send payload to each host and dump it on the filesystem
 
-    Nothing is done in case the file already exists.
+    Hosts where the file already exists, with the same recorded digest if
+    one is given, are skipped.
+
+    The payload is shipped only once per node in the cluster. With
+    broadcast='client' the client sends it to every host where it is
+    missing in a single round: dump_payload writes atomically and lets only
+    one writer per path proceed on shared filesystems. With
+    broadcast='tree' the client only sends it to the first host and the
+    hosts holding the file forward it to the others along a binomial tree.
 
-    The payload is shipped only once per node in the cluster.
+    With stream=True the arrays of the payload (a tuple) are streamed in
+    blocks of about block_size bytes and written directly into memory mapped
+    files on the hosts instead of being serialized as a whole: such payloads
+    are to be loaded with load_data.
+
+    If the content digest of the payload (see hash_payload) is given, it is
+    recorded next to the file on each host and files with a missing or
+    different digest are considered stale and dumped again. The files are
+    written under a temporary name and renamed into place with their digest.
 
     """
     if host_view is None:
@@ -94,29 +877,113 @@ def host_dump(client, payload, target_filename, host_view=None, pre_warm=True):
 
     client = host_view.client
 
-    @interactive
-    def dump_payload(payload, filename):
-        from sklearn.externals import joblib
-        import os
-        folder = os.path.dirname(filename)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        return joblib.dump(payload, filename)
+    def dispatch(engine_ids):
+        if stream:
+            _stream_payload(client, engine_ids, payload, target_filename,
+                            block_size=block_size, digest=digest)
+        else:
+            client[engine_ids].apply_sync(dump_payload, payload,
+                                          target_filename, digest=digest)
 
-    missing_ids = _missing_file_engine_ids(host_view, target_filename)
-    if missing_ids:
+    missing_ids = _missing_file_engine_ids(
+        host_view, [target_filename], digest)
+    if missing_ids and broadcast == 'client' and not stream:
+        # dump_payload writes atomically and serializes the writers of a
+        # shared filesystem: all the hosts can be sent the payload at once
+        dispatch(missing_ids)
+        missing_ids = []
+    elif missing_ids:
         first_id = missing_ids[0]
 
         # Do a first dispatch to the first node to avoid concurrent write in
         # case of shared filesystem
-        client[first_id].apply_sync(dump_payload, payload, target_filename)
+        dispatch([first_id])
 
         # Refetch the list of engine ids where the file is missing
-        missing_ids = _missing_file_engine_ids(host_view, target_filename)
+        missing_ids = _missing_file_engine_ids(
+            host_view, [target_filename], digest)
 
+    if missing_ids and broadcast == 'tree':
+        holder_ids = [engine_id for engine_id in view_engine_ids(host_view)
+                      if engine_id not in missing_ids]
+        _tree_broadcast(client, target_filename, holder_ids, missing_ids)
+    elif missing_ids:
         # Restrict the view to hosts where the target data file is still
         # missing for the final dispatch
-        client[missing_ids].apply_sync(dump_payload, payload, target_filename)
+        dispatch(missing_ids)
 
     if pre_warm:
         warm_mmap(client, [target_filename], host_view=host_view)
+
+
+@interactive
+def write_cv_split(data_filename, train, test, cv_split_filename,
+                   materialize=False):
+    """Write a CV split file of the base data stored in data_filename"""
+    from sklearn.externals import joblib
+    if materialize:
+        from pyrallel.mmap_utils import load_data
+        from pyrallel.mmap_utils import take_rows
+        X, y = load_data(data_filename, mmap_mode='r')
+        cv_fold = (take_rows(X, train), y[train], take_rows(X, test), y[test])
+    else:
+        cv_fold = dict(data=data_filename, train=train, test=test)
+    joblib.dump(cv_fold, cv_split_filename)
+    return cv_split_filename
+
+
+def persist_cv_splits_on_hosts(client, X, y, name=None, n_cv_iter=5,
+                               suffix="_cv_%03d.pkl", train_size=None,
+                               test_size=0.25, random_state=None, folder='.',
+                               materialize=False, host_view=None,
+                               broadcast='client', stream=False):
+    """Persist randomized train test splits by building them on the hosts
+
+    The base data is shipped once per host with host_dump, using the given
+    broadcast and stream modes, and only the train and test indices of each
+    fold are sent to the engines. The folds of each host are then written
+    in parallel by its engines instead of serially by the client.
+
+    As for host_dump, one host is processed first to avoid concurrent
+    writes on shared filesystems.
+    """
+    from sklearn.cross_validation import ShuffleSplit
+    import uuid
+
+    if name is None:
+        name = uuid.uuid4().get_hex()
+    if host_view is None:
+        host_view = get_host_view(client)
+    client = host_view.client
+    topology = get_topology(client)
+
+    data_filename = os.path.abspath(os.path.join(folder, name + '_data.pkl'))
+    host_dump(client, (X, y), data_filename, host_view=host_view,
+              pre_warm=False, broadcast=broadcast, stream=stream)
+
+    cv = ShuffleSplit(X.shape[0], n_iter=n_cv_iter,
+                      test_size=test_size, random_state=random_state)
+    folds = [(train, test, os.path.abspath(
+              os.path.join(folder, name + suffix % i)))
+             for i, (train, test) in enumerate(cv)]
+    cv_split_filenames = [filename for _, _, filename in folds]
+
+    def dispatch(host_engine_ids):
+        tasks = []
+        for host_engine_id in host_engine_ids:
+            engine_ids = topology.engines_on(topology.host_of(host_engine_id))
+            for i, (train, test, filename) in enumerate(folds):
+                engine_id = engine_ids[i % len(engine_ids)]
+                tasks.append(client[engine_id].apply(
+                    write_cv_split, data_filename, train, test, filename,
+                    materialize=materialize))
+        for task in tasks:
+            task.get()
+
+    missing_ids = _missing_file_engine_ids(host_view, cv_split_filenames)
+    if missing_ids:
+        dispatch(missing_ids[:1])
+        missing_ids = _missing_file_engine_ids(host_view, cv_split_filenames)
+        dispatch(missing_ids)
+
+    return cv_split_filenames
@@ -4,22 +4,44 @@ Author: Olivier Grisel <olivier@ogrisel.com>
 Licensed: MIT
 """
 from time import sleep
+from collections import deque
 from collections import namedtuple
 import os
+import threading
+import uuid
 
 from IPython.parallel import interactive
 from IPython.display import clear_output
 from scipy.stats import sem
+from scipy.stats import ttest_rel
 import numpy as np
 
 from sklearn.utils import check_random_state
 from sklearn.grid_search import ParameterGrid
 
+from pyrallel.backends import get_backend
 from pyrallel.common import TaskManager
 from pyrallel.common import is_aborted
-from pyrallel.mmap_utils import warm_mmap_on_cv_splits
+from pyrallel.evaluation_cache import CachedResult
+from pyrallel.evaluation_cache import EvaluationCache
+from pyrallel.evaluation_cache import evaluation_key
+from pyrallel.evaluation_cache import hash_value
+from pyrallel.mmap_utils import cv_split_data_filenames
+from pyrallel.mmap_utils import is_shm_filename
 from pyrallel.mmap_utils import persist_cv_splits
+from pyrallel.tpe import TPEProposer
 
+# Python 2 & 3 compat
+try:
+    basestring
+except NameError:
+    basestring = (str, bytes)
+
+try:
+    from pyrallel.aio import AsyncTaskManagerMixin
+except SyntaxError:
+    # No native coroutines under Python 2
+    AsyncTaskManagerMixin = object
 
 
 
@@ -32,21 +54,17 @@ def compute_evaluation(model, cv_split_filename, params=None,
     # All module imports should be executed in the worker namespace to make
     # possible to run an an engine node.
     from time import time
-    from sklearn.externals import joblib
-
-    X_train, y_train, X_test, y_test = joblib.load(
-        cv_split_filename, mmap_mode=mmap_mode)
-
-    # Slice a subset of the training set for plotting learning curves
-    if train_size <= 1.0:
-        # Assume that train_size is an relative fraction of the number of
-        # samples
-        n_samples_train = int(train_size * X_train.shape[0])
-    else:
-        # Assume that train_size is an absolute number of samples
-        n_samples_train = int(train_size)
-    X_train = X_train[:n_samples_train]
-    y_train = y_train[:n_samples_train]
+    import os
+    import socket
+    from pyrallel.mmap_utils import load_cv_split
+
+    started = time()
+    # Only load a subset of the training set for plotting learning curves
+    # and evaluating small budgets: train_size is either a relative
+    # fraction of the number of samples or an absolute number of samples
+    X_train, y_train, X_test, y_test = load_cv_split(
+        cv_split_filename, mmap_mode=mmap_mode, train_size=train_size)
+    load_time = time() - started
 
     # Configure the model
     if model is not None:
@@ -58,14 +76,20 @@ def compute_evaluation(model, cv_split_filename, params=None,
     train_time = time() - tick
 
     # Compute score on training set
+    tick = time()
     train_score = model.score(X_train, y_train)
 
     # Compute score on test set
     test_score = model.score(X_test, y_test)
+    score_time = time() - tick
+
+    timings = dict(host=socket.gethostname(), pid=os.getpid(),
+                   started=started, load=load_time, fit=train_time,
+                   score=score_time, dump=0.0)
 
     # Wrap evaluation results in a simple tuple datastructure
     return (test_score, train_score, train_time,
-            train_size, params)
+            train_size, params, timings)
 
 
 # Named tuple to collect evaluation results
@@ -74,33 +98,149 @@ Evaluation = namedtuple('Evaluation', (
     'train_score',
     'train_time',
     'train_fraction',
-    'parameters'))
-
-
-class RandomizedGridSeach(TaskManager):
-    """"Async Randomized Parameter search."""
-
-    def __init__(self, load_balanced_view, random_state=0):
+    'parameters',
+    'timings'))
+
+
+def sample_parameters(param_distributions, n_iter, random_state=None):
+    """Lazily draw n_iter parameter settings from param_distributions
+
+    Each value of the param_distributions dict is either a list of values
+    to sample uniformly from or a distribution with a ``rvs`` method such as
+    the frozen distributions of scipy.stats. The settings are drawn
+    independently one at a time so that the search space is never
+    materialized. Settings already drawn are redrawn a few times to avoid
+    duplicates.
+
+        >>> import threading
+        >>> from scipy.stats import uniform
+        >>> grid = {'kernel': ['rbf', 'linear'], 'C': [0.1, 1, 10]}
+        >>> settings = list(sample_parameters(grid, 6, random_state=0))
+        >>> len(set((s['kernel'], s['C']) for s in settings))
+        6
+        >>> settings = list(sample_parameters({'C': uniform(1, 9)}, 3,
+        ...                                   random_state=0))
+        >>> all(1 <= s['C'] <= 10 for s in settings)
+        True
+
+    Settings that cannot be hashed are drawn without avoiding duplicates:
+
+        >>> len(list(sample_parameters({'lock': [threading.Lock()]}, 2)))
+        2
+
+    """
+    random_state = check_random_state(random_state)
+    items = sorted(param_distributions.items())
+    seen = set()
+    for _ in range(n_iter):
+        for _ in range(100):
+            params = {}
+            for name, values in items:
+                if hasattr(values, 'rvs'):
+                    params[name] = values.rvs(random_state=random_state)
+                else:
+                    params[name] = values[random_state.randint(len(values))]
+            try:
+                key = hash_value(params)
+            except TypeError:
+                # Cannot tell whether it was drawn already
+                key = None
+                break
+            if key not in seen:
+                break
+        if key is not None:
+            seen.add(key)
+        yield params
+
+
+class RandomizedGridSeach(TaskManager, AsyncTaskManagerMixin):
+    """"Async Randomized Parameter search.
+
+    load_balanced_view can be an IPython load balanced view or any
+    pyrallel.backends.Backend instance such as a LocalBackend.
+
+    evaluation_cache is an EvaluationCache, or the filename of its SQLite
+    store, where the completed evaluations are recorded: the evaluations
+    found there are reused instead of being submitted again.
+
+    cache_bytes, if not None, sets the budget in bytes of the data files
+    kept on each host by the dataset cache of the backend. With an
+    unlimited budget, the files built on the hosts are removed on reset.
+    """
+
+    def __init__(self, load_balanced_view, random_state=0,
+                 evaluation_cache=None, cache_bytes=None):
+        super(RandomizedGridSeach, self).__init__()
         self.task_groups = []
         self.lb_view = load_balanced_view
+        self.backend = get_backend(load_balanced_view)
+        if cache_bytes is not None:
+            self.backend.dataset_cache.max_bytes = cache_bytes
         self.random_state = random_state
         self._temp_files = []
+        self._host_files = []
+        self._halving = None
+        self._racing = None
+        self._launcher_lock = threading.RLock()
+        if isinstance(evaluation_cache, basestring):
+            evaluation_cache = EvaluationCache(evaluation_cache)
+        self.evaluation_cache = evaluation_cache
+        self._cache_keys = {}
 
     def reset(self):
-        # Abort any other previously scheduled tasks
+        # Stop launching new tasks and abort the previously scheduled ones
+        self._halving = self._racing = None
         self.abort()
 
         # Schedule a new batch of evalutation tasks
         self.task_groups, self.all_parameters = [], []
+        self._cache_keys = {}
+        self._reset_counters()
 
-        # Collect temporary files:
+        # Collect temporary files (the ones written on the engine hosts
+        # might not be visible from the client):
         for filename in self._temp_files:
-            os.unlink(filename)
+            if os.path.exists(filename):
+                os.unlink(filename)
         del self._temp_files[:]
 
+        # Remove the files built on the hosts, in shared memory or on disk
+        # once no other task manager uses them
+        if self._host_files:
+            self.backend.release_host_files(self._host_files)
+            del self._host_files[:]
+
+    def _iter_parameters(self, parameter_grid, n_iter=None):
+        """Iterate over the candidate parameters of the search
+
+        The whole grid is enumerated in random order if n_iter is None,
+        else n_iter candidates are sampled from the distributions of
+        parameter_grid.
+        """
+        random_state = check_random_state(self.random_state)
+        if n_iter is not None:
+            return sample_parameters(parameter_grid, n_iter,
+                                     random_state=random_state)
+        all_parameters = list(ParameterGrid(parameter_grid))
+        random_state.shuffle(all_parameters)
+        return iter(all_parameters)
+
     def launch_for_splits(self, model, parameter_grid, cv_split_filenames,
-                          pre_warm=True, collect_files_on_reset=False):
-        """Launch a Grid Search on precomputed CV splits."""
+                          pre_warm=True, collect_files_on_reset=False,
+                          chunk_size=1, n_iter=None):
+        """Launch a Grid Search on precomputed CV splits.
+
+        With n_iter=None all the points of parameter_grid are evaluated in
+        random order. Otherwise the values of parameter_grid are lists or
+        scipy.stats distributions and n_iter candidates are sampled from
+        them (see sample_parameters).
+
+        chunk_size evaluations are packed in each task and run back to back
+        on the same engine to amortize the scheduling and serialization
+        overhead for cheap models. Use chunk_size='auto' to size the chunks
+        according to the number of workers. The results are still exposed as
+        one task per (parameters, split) evaluation.
+        """
 
         # Abort any existing processing and erase previous state
         self.reset()
@@ -114,43 +254,524 @@ class RandomizedGridSeach(TaskManager):
         # of having concurrent evaluation tasks compete for the the same host
         # disk resources later.
         if pre_warm:
-            warm_mmap_on_cv_splits(self.lb_view.client, cv_split_filenames)
+            self.backend.warm_mmap(cv_split_filenames)
+
+        # Randomize the grid order or sample the candidates
+        self.all_parameters = list(
+            self._iter_parameters(parameter_grid, n_iter))
+
+        n_splits = len(cv_split_filenames)
+        if chunk_size == 'auto':
+            chunk_size = self._auto_chunk_size(
+                len(self.all_parameters) * n_splits)
+
+        if chunk_size > 1:
+            # Split major order so that the evaluations of a batch share the
+            # same data file as much as possible
+            evaluations = [((model, cv_split_filename), dict(params=params))
+                           for cv_split_filename in cv_split_filenames
+                           for params in self.all_parameters]
+            tasks = [self._cached_evaluation(model, args[1], kwargs['params'])
+                     for args, kwargs in evaluations]
+            missing = [i for i, task in enumerate(tasks) if task is None]
+            for start in range(0, len(missing), chunk_size):
+                indices = missing[start:start + chunk_size]
+                batch = [evaluations[i] for i in indices]
+                batch_tasks = self._submit_batch(
+                    compute_evaluation, batch, data_filename=batch[0][0][1])
+                for i, task in zip(indices, batch_tasks):
+                    tasks[i] = task
+                    self._record_key(task, model, evaluations[i][0][1],
+                                     evaluations[i][1]['params'])
+            n_params = len(self.all_parameters)
+            self.task_groups = [tasks[i::n_params] for i in range(n_params)]
+        else:
+            for params in self.all_parameters:
+                task_group = []
+
+                for cv_split_filename in cv_split_filenames:
+                    task = self._submit_evaluation(
+                        model, cv_split_filename, params,
+                        group=len(self.task_groups))
+                    task_group.append(task)
+
+                self.task_groups.append(task_group)
 
-        # Randomize the grid order
-        random_state = check_random_state(self.random_state)
-        self.all_parameters = list(ParameterGrid(parameter_grid))
-        random_state.shuffle(self.all_parameters)
+        # Make it possible to chain method calls
+        return self
 
-        for params in self.all_parameters:
-            task_group = []
+    def launch_successive_halving(self, model, parameter_grid,
+                                  cv_split_filenames, min_train_size=0.1,
+                                  max_train_size=1.0, eta=3, n_brackets=1,
+                                  max_in_flight=None, pre_warm=True,
+                                  collect_files_on_reset=False, n_iter=None,
+                                  proposer=None):
+        """Launch an asynchronous successive halving search on CV splits
+
+        All the candidates are first evaluated with a training set reduced
+        to min_train_size, a fraction of the training set of the splits.
+        Among the candidates evaluated with a budget, the best 1 / eta are
+        promoted to the next budget, eta times larger, up to max_train_size.
+
+        Promotions are decided as soon as all the evaluations of a candidate
+        are completed instead of waiting for all the candidates of a budget
+        (as in ASHA): whenever fewer than max_in_flight evaluations (2 per
+        worker by default) are in flight, a promotable candidate is launched
+        if any, else a new candidate with the smallest budget.
+
+        With n_brackets > 1, the candidates are distributed round robin over
+        brackets of successive halving with smallest budgets eta times larger
+        from one bracket to the next, as in asynchronous Hyperband.
+
+        As for launch_for_splits, n_iter candidates are sampled from the
+        distributions of parameter_grid if n_iter is not None. The
+        candidates are only drawn when there is room to evaluate them.
+
+        If a proposer such as a pyrallel.tpe.TPEProposer is given, the n_iter
+        candidates are proposed by it from the results of the evaluations
+        completed so far instead.
+        """
+        if proposer is not None and n_iter is None:
+            raise ValueError("n_iter is required to use a proposer")
+        self.reset()
+        self.parameter_grid = parameter_grid
 
-            for cv_split_filename in cv_split_filenames:
-                task = self.lb_view.apply(
-                    compute_evaluation,
-                    model, cv_split_filename, params=params)
-                task_group.append(task)
+        if collect_files_on_reset:
+            self._temp_files.extend(cv_split_filenames)
+        if pre_warm:
+            self.backend.warm_mmap(cv_split_filenames)
+
+        # Geometric budgets ending at max_train_size
+        n_rungs = int(np.log(max_train_size / min_train_size) / np.log(eta)
+                      + 1e-9) + 1
+        budgets = [max_train_size / eta ** k
+                   for k in reversed(range(n_rungs))]
+        n_brackets = max(1, min(n_brackets, n_rungs))
+        self.brackets = [budgets[b:] for b in range(n_brackets)]
+
+        if proposer is not None:
+            candidates = self._propose_parameters(proposer, n_iter)
+        else:
+            candidates = self._iter_parameters(parameter_grid, n_iter)
+
+        if max_in_flight is None:
+            max_in_flight = 2 * self.backend.n_workers()
+        self._halving = dict(
+            model=model, cv_split_filenames=cv_split_filenames, eta=eta,
+            max_in_flight=max_in_flight, candidates=candidates,
+            exhausted=False, running={}, results={}, promoted=set(),
+            advancing=False)
+        self._fill_window()
 
+        # Make it possible to chain method calls
+        return self
+
+    def _launching(self):
+        halving, racing = self._halving, self._racing
+        with self._launcher_lock:
+            if halving is not None:
+                return (bool(halving['running']) or not halving['exhausted']
+                        or self._promotable_job(halving) is not None)
+            if racing is not None:
+                return bool(racing['open'])
+        return False
+
+    def _fill_window(self):
+        super(RandomizedGridSeach, self)._fill_window()
+        for state, advance in ((self._halving, self._advance_halving),
+                               (self._racing, self._advance_racing)):
+            if state is None:
+                continue
+            with self._launcher_lock:
+                if not state['advancing']:
+                    state['advancing'] = True
+                    try:
+                        advance(state)
+                    finally:
+                        state['advancing'] = False
+
+    def _advance_halving(self, halving):
+        """Record the completed candidates and launch the next ones"""
+        in_flight = 0
+        for job, task_group in list(halving['running'].items()):
+            n_running = sum(not task.ready() for task in task_group)
+            if n_running:
+                in_flight += n_running
+                continue
+            del halving['running'][job]
+            scores = []
+            for task in task_group:
+                try:
+                    scores.append(self._task_result(task).validation_score)
+                except Exception:
+                    # Aborted or failed evaluation: never promoted
+                    break
+            else:
+                candidate, bracket, rung = job
+                halving['results'].setdefault((bracket, rung), []).append(
+                    (np.mean(scores), candidate))
+
+        n_splits = len(halving['cv_split_filenames'])
+        while in_flight < halving['max_in_flight']:
+            job = self._next_halving_job(halving)
+            if job is None:
+                break
+            candidate, bracket, rung = job
+            if rung > 0:
+                halving['promoted'].add((bracket, rung - 1, candidate))
+
+            params = self.all_parameters[candidate]
+            train_size = self.brackets[bracket][rung]
+            task_group = [
+                self._submit_evaluation(halving['model'], f, params,
+                                        train_size=train_size,
+                                        group=train_size)
+                for f in halving['cv_split_filenames']]
             self.task_groups.append(task_group)
+            halving['running'][job] = task_group
+            in_flight += n_splits
+
+    def _next_halving_job(self, halving):
+        """Return the next (candidate, bracket, rung) to evaluate or None
+
+        Promotions come first, a new candidate is drawn otherwise.
+        """
+        job = self._promotable_job(halving)
+        if job is not None:
+            return job
+        params = next(halving['candidates'], None)
+        if params is None:
+            halving['exhausted'] = True
+            return None
+        self.all_parameters.append(params)
+        candidate = len(self.all_parameters) - 1
+        return candidate, candidate % len(self.brackets), 0
+
+    def _promotable_job(self, halving):
+        """Return the next candidate promotion or None
+
+        Promotions to the largest budgets come first.
+        """
+        eta = halving['eta']
+        n_rungs = max(len(budgets) for budgets in self.brackets)
+        for rung in reversed(range(n_rungs - 1)):
+            for bracket, budgets in enumerate(self.brackets):
+                if rung >= len(budgets) - 1:
+                    continue
+                results = sorted(halving['results'].get((bracket, rung), []),
+                                 reverse=True)
+                for _, candidate in results[:len(results) // eta]:
+                    if (bracket, rung, candidate) not in halving['promoted']:
+                        return candidate, bracket, rung + 1
+        return None
+
+    def _propose_parameters(self, proposer, n_iter):
+        """Iterate over n_iter candidates proposed from the past results
+
+        The proposer is fit on the mean validation scores of the largest
+        training set budget with at least proposer.n_initial completed
+        candidates, the smallest budget otherwise.
+        """
+        random_state = check_random_state(self.random_state)
+        for _ in range(n_iter):
+            halving = self._halving
+            by_budget = {}
+            for (bracket, rung), results in halving['results'].items():
+                budget = self.brackets[bracket][rung]
+                by_budget.setdefault(budget, []).extend(results)
+            observed = []
+            for budget in sorted(by_budget, reverse=True):
+                observed = by_budget[budget]
+                if len(observed) >= proposer.n_initial:
+                    break
+            observed = [(self.all_parameters[candidate], score)
+                        for score, candidate in observed]
+            pending = [self.all_parameters[candidate]
+                       for candidate, _, _ in halving['running']]
+            yield proposer.propose(observed, pending, random_state)
+
+    def launch_model_based(self, model, param_distributions,
+                           cv_split_filenames, n_iter, proposer=None,
+                           train_size=1.0, max_in_flight=None,
+                           pre_warm=True, collect_files_on_reset=False):
+        """Launch a model based search of n_iter candidates on CV splits
+
+        A new candidate is proposed each time an evaluation completes and
+        fewer than max_in_flight evaluations (one per worker by default)
+        are running. The candidates are proposed by a TPEProposer of
+        param_distributions unless another proposer is given.
+        """
+        if proposer is None:
+            proposer = TPEProposer(param_distributions)
+        if max_in_flight is None:
+            max_in_flight = self.backend.n_workers()
+        return self.launch_successive_halving(
+            model, param_distributions, cv_split_filenames,
+            min_train_size=train_size, max_train_size=train_size,
+            max_in_flight=max_in_flight, pre_warm=pre_warm,
+            collect_files_on_reset=collect_files_on_reset, n_iter=n_iter,
+            proposer=proposer)
+
+    def launch_racing(self, model, parameter_grid, cv_split_filenames,
+                      min_folds=3, alpha=0.05, pre_warm=True,
+                      collect_files_on_reset=False, n_iter=None):
+        """Launch a search racing the candidates over the CV splits
+
+        The evaluations of every candidate on the first min_folds splits are
+        launched first. The leader is the candidate with the best mean
+        validation score over at least two splits. The validation scores of
+        each other candidate are compared with the ones of the leader on
+        the splits evaluated for both with a one sided paired t-test: the
+        candidates worse than the leader at the alpha level are eliminated
+        and their evaluations that have not started yet are aborted.
+
+        The other candidates stay close to the top and are evaluated on one
+        more split each time all their launched evaluations are completed,
+        up to all the cv_split_filenames.
+        """
+        self.reset()
+        self.parameter_grid = parameter_grid
+
+        if collect_files_on_reset:
+            self._temp_files.extend(cv_split_filenames)
+        if pre_warm:
+            self.backend.warm_mmap(cv_split_filenames)
+
+        self.all_parameters = list(
+            self._iter_parameters(parameter_grid, n_iter))
+        n_candidates = len(self.all_parameters)
+        racing = dict(
+            model=model, cv_split_filenames=cv_split_filenames, alpha=alpha,
+            scores=[{} for _ in range(n_candidates)], means={}, leader=None,
+            unrecorded={}, completed=deque(), open=set(range(n_candidates)),
+            eliminated=set(), advancing=False)
+        self.task_groups = [[] for _ in range(n_candidates)]
+        min_folds = max(1, min(min_folds, len(cv_split_filenames)))
+        with self._launcher_lock:
+            self._racing = racing
+            for candidate in range(n_candidates):
+                for _ in range(min_folds):
+                    self._race_fold(racing, candidate)
+        self._fill_window()
 
         # Make it possible to chain method calls
         return self
 
+    def _race_fold(self, racing, candidate):
+        """Launch the evaluation of candidate on its next split"""
+        task_group = self.task_groups[candidate]
+        fold = len(task_group)
+        task = self._submit_evaluation(
+            racing['model'], racing['cv_split_filenames'][fold],
+            self.all_parameters[candidate])
+        task_group.append(task)
+        racing['unrecorded'][task] = (candidate, fold)
+        if len(task_group) >= len(racing['cv_split_filenames']):
+            racing['open'].discard(candidate)
+        if task.ready():
+            # Found in the evaluation cache
+            racing['completed'].append(task)
+
+    def _advance_racing(self, racing):
+        """Eliminate the dominated candidates and extend the other ones
+
+        Only the results completed since the previous call are recorded and
+        only the candidates they belong to are tested again, unless the
+        leader changes.
+        """
+        updated = set()
+        completed = racing['completed']
+        while completed:
+            task = completed.popleft()
+            recorded = racing['unrecorded'].pop(task, None)
+            if recorded is None:
+                continue
+            candidate, fold = recorded
+            updated.add(candidate)
+            if is_aborted(task):
+                continue
+            try:
+                score = self._task_result(task).validation_score
+            except Exception:
+                # Failed evaluation
+                continue
+            racing['scores'][candidate][fold] = score
+
+        eliminated, means = racing['eliminated'], racing['means']
+        updated -= eliminated
+        if not updated:
+            return
+        for candidate in updated:
+            scores = racing['scores'][candidate]
+            if len(scores) >= 2:
+                means[candidate] = np.mean(list(scores.values()))
+
+        leader = max(means, key=means.get) if means else None
+        if leader != racing['leader'] or leader in updated:
+            # All the contenders are to be compared to the new scores
+            tested = list(means)
+        else:
+            tested = [candidate for candidate in updated
+                      if candidate in means]
+        racing['leader'] = leader
+        leader_scores = racing['scores'][leader] if leader is not None else {}
+        for candidate in tested:
+            scores = racing['scores'][candidate]
+            folds = sorted(set(scores).intersection(leader_scores))
+            if candidate == leader or len(folds) < 2:
+                continue
+            a = [leader_scores[fold] for fold in folds]
+            b = [scores[fold] for fold in folds]
+            if np.mean(a) <= np.mean(b):
+                continue
+            _, p_value = ttest_rel(a, b)
+            if p_value / 2 < racing['alpha']:
+                # nan p-values (no variation at all) never eliminate
+                eliminated.add(candidate)
+                del means[candidate]
+                racing['open'].discard(candidate)
+                self.abort(self.task_groups[candidate])
+
+        for candidate in updated:
+            if (candidate in racing['open']
+                    and all(task.ready()
+                            for task in self.task_groups[candidate])):
+                self._race_fold(racing, candidate)
+
     def launch_for_arrays(self, model, parameter_grid, X, y, n_cv_iter=5,
                           train_size=None, test_size=0.25, pre_warm=True,
-                          folder=".", name=None, random_state=None):
-        cv_split_filenames = persist_cv_splits(
+                          folder=".", name=None, random_state=None,
+                          chunk_size=1, materialize=False,
+                          split_on_engines=False, n_iter=None):
+        """Persist CV splits of X, y and launch a Grid Search on them
+
+        With split_on_engines=True, the base data is shipped once per host
+        and the folds are built in parallel by the engines of each host
+        instead of serially on the client.
+
+        With a backend using shared memory storage, the CV splits are always
+        built on the hosts and held in their RAM until the next reset.
+
+        The files built on the hosts on disk are left to the dataset cache of
+        the backend when it has a byte budget and removed on reset otherwise.
+        """
+        # Release the files of the previous launch before building new ones
+        self.reset()
+        if name is None:
+            name = uuid.uuid4().hex
+        folder = self.backend.data_folder(folder)
+        in_shm = is_shm_filename(folder)
+        if split_on_engines or in_shm:
+            persist = self.backend.persist_cv_splits
+        else:
+            persist = persist_cv_splits
+        cv_split_filenames = persist(
             X, y, n_cv_iter=n_cv_iter, train_size=train_size,
             test_size=test_size, name=name, folder=folder,
-            random_state=random_state)
-        return self.launch_for_splits(
+            random_state=random_state, materialize=materialize)
+        data_filename = os.path.abspath(
+            os.path.join(folder, name + '_data.pkl'))
+
+        # Files built on the hosts are managed by the dataset cache of the
+        # backend if it evicts them: register them before the tasks that pin
+        # them are submitted
+        on_hosts = split_on_engines or in_shm
+        dataset_cache = self.backend.dataset_cache
+        cached = (on_hosts and not in_shm and dataset_cache is not None
+                  and dataset_cache.max_bytes is not None)
+        if cached:
+            dataset_cache.add(cv_split_filenames + [data_filename])
+
+        self.launch_for_splits(
             model, parameter_grid, cv_split_filenames, pre_warm=pre_warm,
-            collect_files_on_reset=True)
+            collect_files_on_reset=not on_hosts,
+            chunk_size=chunk_size, n_iter=n_iter)
+        if on_hosts and not cached:
+            host_files = cv_split_filenames + [data_filename]
+            self.backend.acquire_host_files(host_files)
+            self._host_files.extend(host_files)
+        elif not on_hosts:
+            self._temp_files.extend(
+                cv_split_data_filenames(cv_split_filenames))
+        return self
+
+    def _submit_evaluation(self, model, cv_split_filename, params,
+                           train_size=None, group=None):
+        """Submit the evaluation of params unless it is in the cache"""
+        kwargs = dict(params=params)
+        if train_size is not None:
+            kwargs['train_size'] = train_size
+        task = self._cached_evaluation(model, cv_split_filename, params,
+                                       train_size)
+        if task is None:
+            task = self._submit(compute_evaluation, (model, cv_split_filename),
+                                kwargs, data_filename=cv_split_filename,
+                                group=group)
+            self._record_key(task, model, cv_split_filename, params,
+                             train_size)
+        return task
+
+    def _cached_evaluation(self, model, cv_split_filename, params,
+                           train_size=None):
+        """Tracked CachedResult of the evaluation or None if not cached"""
+        if self.evaluation_cache is None:
+            return None
+        key = evaluation_key(model, params, cv_split_filename,
+                             1.0 if train_size is None else train_size)
+        evaluation = None if key is None else self.evaluation_cache.get(key)
+        if evaluation is None:
+            return None
+        return self._track(CachedResult(evaluation))
+
+    def _record_key(self, task, model, cv_split_filename, params,
+                    train_size=None):
+        """Store the result of task in the cache when it completes"""
+        if self.evaluation_cache is None:
+            return
+        key = evaluation_key(model, params, cv_split_filename,
+                             1.0 if train_size is None else train_size)
+        if key is not None:
+            self._cache_keys[task] = key
+            if task.ready():
+                # Completed before its key was recorded
+                self._task_done(task)
+
+    def _task_done(self, task):
+        super(RandomizedGridSeach, self)._task_done(task)
+        racing = self._racing
+        if racing is not None and task in racing['unrecorded']:
+            racing['completed'].append(task)
+        key = self._cache_keys.pop(task, None)
+        if key is None or is_aborted(task):
+            return
+        try:
+            evaluation = task.get()
+        except Exception:
+            # Failed evaluations are not cached
+            return
+        self.evaluation_cache.put(key, evaluation)
+
+    def _task_result(self, task):
+        return Evaluation(*task.get())
+
+    def _task_timings(self, task):
+        return self._task_result(task).timings
 
     def find_bests(self, n_top=5):
-        """Compute the mean score of the completed tasks"""
+        """Compute the mean score of the completed tasks
+
+        Candidates evaluated with larger training sets rank first. The
+        candidates eliminated by launch_racing are left out: their means are
+        over fewer splits than the ones of the other candidates.
+        """
         mean_scores = []
+        eliminated = ()
+        if self._racing is not None:
+            eliminated = self._racing['eliminated']
 
-        for params, task_group in zip(self.all_parameters, self.task_groups):
+        for candidate, task_group in enumerate(self.task_groups):
+            if candidate in eliminated:
+                continue
             evaluations = [Evaluation(*t.get())
                            for t in task_group
                            if t.ready() and not is_aborted(t)]
@@ -159,11 +780,14 @@ class RandomizedGridSeach(TaskManager):
                 continue
             val_scores = [e.validation_score for e in evaluations]
             train_scores = [e.train_score for e in evaluations]
-            mean_scores.append((np.mean(val_scores), sem(val_scores),
-                                np.mean(train_scores), sem(train_scores),
-                                params))
+            mean_scores.append((evaluations[0].train_fraction, (
+                np.mean(val_scores), sem(val_scores),
+                np.mean(train_scores), sem(train_scores),
+                evaluations[0].parameters)))
 
-        return sorted(mean_scores, reverse=True)[:n_top]
+        mean_scores.sort(key=lambda item: (item[0], item[1][0]),
+                         reverse=True)
+        return [scores for _, scores in mean_scores[:n_top]]
 
     def report(self, n_top=5):
         bests = self.find_bests(n_top=n_top)
@@ -178,8 +802,12 @@ class RandomizedGridSeach(TaskManager):
     def __repr__(self):
         return self.report()
 
-    def boxplot_parameters(self, display_train=False):
-        """Plot boxplot for each parameters independently"""
+    def boxplot_parameters(self, display_train=False, n_bins=5):
+        """Plot boxplot for each parameters independently
+
+        The values sampled from continuous distributions are grouped in
+        n_bins bins of equal counts.
+        """
         import pylab as pl
         results = [Evaluation(*task.get())
                    for task_group in self.task_groups
@@ -191,15 +819,30 @@ class RandomizedGridSeach(TaskManager):
         grid_items = self.parameter_grid.items()
         for i, (param_name, param_values) in enumerate(grid_items):
             pl.subplot(n_rows, 1, i + 1)
+            sampled = [r.parameters[param_name] for r in results]
+            if hasattr(param_values, 'rvs'):
+                if len(sampled) == 0:
+                    continue
+                sampled = np.asarray(sampled, dtype=np.float64)
+                edges = np.unique(np.percentile(
+                    sampled, np.linspace(0, 100, n_bins + 1)))
+                bins = np.searchsorted(edges[1:-1], sampled, side='right')
+                param_values = ["%0.3g-%0.3g" % (low, high)
+                                for low, high in zip(edges[:-1], edges[1:])]
+                if len(edges) == 1:
+                    param_values = ["%0.3g" % edges[0]]
+            else:
+                bins = np.array([list(param_values).index(value)
+                                 for value in sampled], dtype=np.int64)
             val_scores_per_value = []
             train_scores_per_value = []
-            for param_value in param_values:
-                train_scores = [r.train_score for r in results
-                                if r.parameters[param_name] == param_value]
+            for j in range(len(param_values)):
+                train_scores = [r.train_score for r, b in zip(results, bins)
+                                if b == j]
                 train_scores_per_value.append(train_scores)
 
-                val_scores = [r.validation_score for r in results
-                              if r.parameters[param_name] == param_value]
+                val_scores = [r.validation_score
+                              for r, b in zip(results, bins) if b == j]
                 val_scores_per_value.append(val_scores)
 
             widths = 0.25
@@ -222,13 +865,14 @@ class RandomizedGridSeach(TaskManager):
     def monitor(self, plot=False):
         try:
             while not self.done():
-                self.lb_view.spin()
+                self.backend.spin()
                 if plot:
                     import pylab as pl
                     pl.clf()
                     self.boxplot_parameters()
                 clear_output()
                 print(self.report())
+                self._maybe_speculate()
                 if plot:
                     pl.show()
                 sleep(1)
@@ -0,0 +1,187 @@
+"""Tree-structured Parzen Estimator to propose hyper-parameters
+
+Author: Pyrallel contributors
+Licensed: MIT
+"""
+import numpy as np
+from scipy import stats
+
+
+def _bounds(dist):
+    """Bounds of the bulk of the support of a distribution with rvs"""
+    try:
+        if hasattr(dist, 'support'):
+            low, high = dist.support()
+        else:
+            low, high = dist.ppf(0.0), dist.ppf(1.0)
+            if isinstance(getattr(dist, 'dist', None), stats.rv_discrete):
+                # ppf(0) is the integer just below the support
+                low += 1
+        if not np.isfinite(low):
+            low = dist.ppf(0.001)
+        if not np.isfinite(high):
+            high = dist.ppf(0.999)
+    except AttributeError:
+        # Only rvs: estimate the bounds from a sample
+        sample = dist.rvs(size=1000, random_state=np.random.RandomState(0))
+        low, high = np.min(sample), np.max(sample)
+    return float(low), float(high)
+
+
+class TPEProposer(object):
+    """Propose candidates with a Tree-structured Parzen Estimator
+
+    The observed (params, score) pairs are split between the gamma fraction
+    (at most max_good) with the best scores and the others. n_candidates
+    are drawn from the density l(x) of the parameters of the best ones and
+    the candidate that maximizes l(x) / g(x), g(x) being the density of
+    the others, is proposed. The first n_initial candidates are sampled
+    from the priors.
+
+    The evaluations still pending are accounted with a constant liar: they
+    are considered observed with the worst score so far so that concurrent
+    proposals are kept apart.
+
+    The values of param_distributions are lists of values, modelled with
+    categorical distributions, or distributions with a rvs method such as
+    the scipy.stats frozen distributions, modelled with Gaussian kernel
+    density estimates. Positive distributions spanning several orders of
+    magnitude are modelled in log scale. The proposals are kept within the
+    support of the distributions:
+
+    >>> import numpy as np
+    >>> from scipy.stats import randint, uniform
+    >>> proposer = TPEProposer({'k': randint(1, 10), 'x': uniform(2, 3)},
+    ...                        n_initial=5)
+    >>> random_state = np.random.RandomState(0)
+    >>> observed = []
+    >>> for _ in range(50):
+    ...     params = proposer.propose(observed, [], random_state)
+    ...     observed.append((params, -params['k'] - params['x']))
+    >>> all(1 <= p['k'] <= 9 and 2 <= p['x'] <= 5 for p, _ in observed)
+    True
+    >>> max(observed, key=lambda o: o[1])[0]['k']
+    1
+    """
+
+    def __init__(self, param_distributions, n_initial=10, gamma=0.1,
+                 max_good=25, n_candidates=24, prior_weight=1.0):
+        self.param_distributions = param_distributions
+        self.n_initial = n_initial
+        self.gamma = gamma
+        self.max_good = max_good
+        self.n_candidates = n_candidates
+        self.prior_weight = prior_weight
+        self._dimensions = []
+        for name, values in sorted(param_distributions.items()):
+            if not hasattr(values, 'rvs'):
+                self._dimensions.append((name, 'categorical', list(values)))
+                continue
+            low, high = _bounds(values)
+            log = low > 0 and high / low >= 100
+            discrete = isinstance(getattr(values, 'dist', None),
+                                  stats.rv_discrete)
+            self._dimensions.append((name, 'numerical', dict(
+                dist=values, low=low, high=high, log=log,
+                discrete=discrete)))
+
+    def propose(self, observed, pending, random_state):
+        """Return the parameters of the next candidate to evaluate
+
+        observed is the list of the (params, score) of the completed
+        evaluations, higher scores being better, and pending the list of the
+        params still being evaluated.
+        """
+        if len(observed) < self.n_initial:
+            return self._sample([], random_state, prior_only=True)
+
+        liar = min(score for _, score in observed)
+        points = list(observed) + [(params, liar) for params in pending]
+        points.sort(key=lambda point: point[1], reverse=True)
+        n_good = max(1, min(int(np.ceil(self.gamma * len(points))),
+                            self.max_good))
+        good = [params for params, _ in points[:n_good]]
+        bad = [params for params, _ in points[n_good:]]
+
+        candidates = [self._sample(good, random_state)
+                      for _ in range(self.n_candidates)]
+        log_ratio = (self._log_density(candidates, good)
+                     - self._log_density(candidates, bad))
+        return candidates[int(np.argmax(log_ratio))]
+
+    def _sample(self, group, random_state, prior_only=False):
+        """Draw parameters from the density of group mixed with the priors"""
+        params = {}
+        for name, kind, info in self._dimensions:
+            values = [p[name] for p in group]
+            if kind == 'categorical':
+                weights = self._categorical_weights(values, info)
+                params[name] = info[random_state.choice(len(info), p=weights)]
+                continue
+
+            n = len(values)
+            if prior_only or (random_state.rand()
+                              < self.prior_weight / (n + self.prior_weight)):
+                params[name] = info['dist'].rvs(random_state=random_state)
+                continue
+            centers, bandwidth, low, high = self._kernels(values, info)
+            z = centers[random_state.randint(n)]
+            z = np.clip(z + bandwidth * random_state.randn(), low, high)
+            params[name] = self._inverse_transform(z, info)
+        return params
+
+    def _log_density(self, candidates, group):
+        """Log density of each candidate under the model of group"""
+        log_density = np.zeros(len(candidates))
+        for name, kind, info in self._dimensions:
+            values = [p[name] for p in group]
+            if kind == 'categorical':
+                weights = self._categorical_weights(values, info)
+                log_density += np.log([weights[info.index(c[name])]
+                                       for c in candidates])
+                continue
+
+            z = np.array([self._transform(c[name], info)
+                          for c in candidates])
+            n = len(values)
+            density = np.zeros(len(candidates))
+            if n:
+                centers, bandwidth, low, high = self._kernels(values, info)
+                for center in centers:
+                    density += stats.norm.pdf(z, center, bandwidth)
+            else:
+                low, high = self._transformed_bounds(info)
+            density += self.prior_weight / max(high - low, 1e-12)
+            log_density += np.log(density / (n + self.prior_weight))
+        return log_density
+
+    def _categorical_weights(self, values, choices):
+        counts = np.empty(len(choices))
+        counts.fill(self.prior_weight / len(choices))
+        for value in values:
+            counts[choices.index(value)] += 1
+        return counts / counts.sum()
+
+    def _kernels(self, values, info):
+        low, high = self._transformed_bounds(info)
+        centers = np.array([self._transform(v, info) for v in values])
+        n = len(centers)
+        bandwidth = max(1.06 * np.std(centers) * n ** -0.2,
+                        (high - low) / min(100., 1. + n), 1e-12)
+        if info['discrete'] and not info['log']:
+            # Keep the neighboring integers within reach
+            bandwidth = max(bandwidth, 1.)
+        return centers, bandwidth, low, high
+
+    def _transformed_bounds(self, info):
+        return (self._transform(info['low'], info),
+                self._transform(info['high'], info))
+
+    def _transform(self, value, info):
+        return np.log(value) if info['log'] else float(value)
+
+    def _inverse_transform(self, z, info):
+        value = np.exp(z) if info['log'] else z
+        if info['discrete']:
+            value = int(np.clip(np.round(value), info['low'], info['high']))
+        return value